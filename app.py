@@ -1,17 +1,58 @@
+import time
+_T_AVVIO = time.perf_counter()
+
 import streamlit as st
 import pandas as pd
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from datetime import datetime, timedelta
-import PyPDF2
+from concurrent.futures import ThreadPoolExecutor
 import re
 import sqlite3
 import io
+import hashlib
+import archivio
+import esporta
+import os
+from urllib.parse import quote
+from bozze import (
+    ConflittoVersione, applica_a_programma, carica_bozza, init_schema, modifiche_da,
+    salva_bozza, scrittore, versione_bozza
+)
+from validazione import NORMALIZZATORI, Problema
+from briefing import genera_pacchetto_briefing, turni_per_volontario
+from pianificatore import (
+    COLORE_CANE_SCONOSCIUTO, TRACCIA_MAX_EVENTI, Livello, Turno, genera_programma, inserisci_turno,
+    nuova_traccia, simula_assenze, turno_compatibile, verifica_compatibilita_colore
+)
+
+_T_IMPORT = time.perf_counter()
 
 # --- CONFIGURAZIONE ---
 st.set_page_config(page_title="Programma Canile Pro", layout="wide")
 
+# Percorso del database e URL dei fogli sovrascrivibili da ambiente (es. per prova_carico.py)
+DB_PATH = os.environ.get("CANILE_DB", "canile.db")
+# Mesi chiusi dello storico archiviati in file compressi accanto al database
+CARTELLA_ARCHIVIO = archivio.cartella_archivio(DB_PATH)
+URL_FOGLI = os.environ.get(
+    "CANILE_URL_FOGLI",
+    "https://docs.google.com/spreadsheets/d/1pcFa454IT1tlykbcK-BeAU9hnIQ_D8V_UuZaKI_KtYM/gviz/tq?tqx=out:csv&sheet={foglio}"
+)
+FOGLI = ("Cani", "Volontari", "Luoghi")
+CAMPI_ANAGRAFICA = ["cibo", "guinzaglieria", "strumenti", "attivita", "note", "tempo"]
+RIGHE_PER_PAGINA = [25, 50, 100]
+TRONCA_TESTO = 80
+GENERAZIONI_IN_CACHE = 32
+TABELLE_IN_CACHE = 16
+COLONNE_TESTO_PROGRAMMA = ["CIBO", "GUINZAGLIERIA", "STRUMENTI", "ATTIVITÀ", "NOTE", "TEMPO"]
+STATO_COMPATIBILITA = {"⚠️ INCOMPATIBILE": "🟥", "✅ OK": "🟩"}
+
+@st.cache_resource
 def init_db():
-    """Inizializza il database canile.db con le tabelle necessarie."""
-    conn = sqlite3.connect('canile.db')
+    """Inizializza il database canile.db con le tabelle necessarie (una volta per processo)."""
+    conn = sqlite3.connect(DB_PATH)
+    # WAL: le letture non bloccano lo scrittore (impostazione persistente del file)
+    conn.execute("PRAGMA journal_mode=WAL")
     c = conn.cursor()
     # Storico per statistiche
     c.execute('''CREATE TABLE IF NOT EXISTS storico 
@@ -20,8 +61,63 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS anagrafica_cani 
                  (nome TEXT PRIMARY KEY, cibo TEXT, guinzaglieria TEXT, strumenti TEXT, 
                   attivita TEXT, note TEXT, tempo TEXT)''')
+    # Contatori di versione dei dati, incrementati a ogni scrittura (invalidano le cache delle viste)
+    c.execute('''CREATE TABLE IF NOT EXISTS versioni_dati 
+                 (nome TEXT PRIMARY KEY, valore INTEGER NOT NULL DEFAULT 0)''')
+    # Indice full-text sull'anagrafica (rowid = rowid di anagrafica_cani), aggiornato da salva_anagrafica_db
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS anagrafica_fts USING fts5
+                 (nome, cibo, guinzaglieria, strumenti, attivita, note, tempo,
+                  tokenize='unicode61 remove_diacritics 2', prefix='2 3')''')
+    # Bozze del programma condivise tra coordinatori
+    init_schema(c)
+    # Indici dello storico e archivio dei mesi chiusi
+    archivio.init_schema(c)
+    # Revisioni per le esportazioni incrementali (esporta.py)
+    esporta.init_schema(c)
+    n_ana = c.execute("SELECT COUNT(*) FROM anagrafica_cani").fetchone()[0]
+    n_fts = c.execute("SELECT COUNT(*) FROM anagrafica_fts").fetchone()[0]
+    if n_ana != n_fts:
+        # Indice mancante o non allineato (es. database creato prima dell'indice): ricostruzione
+        c.execute("DELETE FROM anagrafica_fts")
+        c.execute('''INSERT INTO anagrafica_fts (rowid, nome, cibo, guinzaglieria, strumenti, attivita, note, tempo)
+                     SELECT rowid, nome, cibo, guinzaglieria, strumenti, attivita, note, tempo FROM anagrafica_cani''')
     conn.commit()
     conn.close()
+    # Riepiloghi mancanti (ultime uscite, revisioni), una volta per processo
+    scrittore(DB_PATH).esegui(archivio.ricostruisci_ultime_uscite, CARTELLA_ARCHIVIO)
+    scrittore(DB_PATH).esegui(esporta.ricostruisci_revisioni, CARTELLA_ARCHIVIO)
+
+@st.cache_resource
+def passaggi_archivio():
+    """Giorno dell'ultimo passaggio di archiviazione del processo."""
+    return {"giorno": None}
+
+def archivia_se_serve():
+    """
+    Una volta al giorno (per processo) sposta negli archivi i mesi usciti dalla
+    finestra calda, così un server sempre acceso non accumula mesi chiusi, e
+    rimuove i file di archivio non più registrati.
+    """
+    stato = passaggi_archivio()
+    oggi = datetime.today().date()
+    if stato["giorno"] == oggi:
+        return
+    stato["giorno"] = oggi
+    scrittore(DB_PATH).esegui(archivio.archivia_mesi_chiusi, CARTELLA_ARCHIVIO)
+    archivio.pulisci_archivi(DB_PATH, CARTELLA_ARCHIVIO)
+
+def versione_dati(nome):
+    """Restituisce la versione corrente di un insieme di dati ('anagrafica', 'storico')."""
+    conn = sqlite3.connect(DB_PATH)
+    riga = conn.execute("SELECT valore FROM versioni_dati WHERE nome=?", (nome,)).fetchone()
+    conn.close()
+    return riga[0] if riga else 0
+
+def incrementa_versione(conn, nome):
+    """Incrementa la versione di un insieme di dati, nella transazione della scrittura; restituisce la nuova."""
+    return conn.execute("""INSERT INTO versioni_dati (nome, valore) VALUES (?, 1)
+                           ON CONFLICT(nome) DO UPDATE SET valore = valore + 1
+                           RETURNING valore""", (nome,)).fetchone()[0]
 
 def parse_dog_pdf(uploaded_file):
     """
@@ -30,6 +126,8 @@ def parse_dog_pdf(uploaded_file):
     I titoli sono in MAIUSCOLO e GRASSETTO.
     Il contenuto è tutto ciò che segue il titolo fino al prossimo titolo o fine documento.
     """
+    import PyPDF2
+
     reader = PyPDF2.PdfReader(uploaded_file)
     
     # Estrai tutto il testo dal PDF
@@ -84,18 +182,105 @@ def parse_dog_pdf(uploaded_file):
     
     return dati
 
-def carica_anagrafica():
-    """Carica l'anagrafica dei cani dal database."""
-    conn = sqlite3.connect("canile.db")
+@st.cache_data(max_entries=2, show_spinner=False)
+def carica_anagrafica(versione):
+    """Carica l'anagrafica dei cani dal database (in cache finché `versione` non cambia)."""
+    conn = sqlite3.connect(DB_PATH)
     df = pd.read_sql("SELECT * FROM anagrafica_cani", conn)
     conn.close()
     return df
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def carica_storico(data_inizio, data_fine, versione):
+    """
+    Carica lo storico nel periodo indicato, leggendo gli archivi solo se il periodo
+    li raggiunge (in cache finché `versione` non cambia).
+    """
+    conn = sqlite3.connect(DB_PATH)
+    df = archivio.leggi_storico(conn, CARTELLA_ARCHIVIO, data_inizio, data_fine)
+    conn.close()
+    return df
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def carica_pagina_anagrafica(filtro, limite, offset, versione):
+    """
+    Carica una sola pagina dell'anagrafica, filtrata per nome.
+    Returns:
+        tuple: (DataFrame della pagina, numero totale di cani che soddisfano il filtro)
+    """
+    conn = sqlite3.connect(DB_PATH)
+    parametro = f"%{filtro}%"
+    totale = conn.execute("SELECT COUNT(*) FROM anagrafica_cani WHERE nome LIKE ?", (parametro,)).fetchone()[0]
+    df = pd.read_sql_query(
+        "SELECT * FROM anagrafica_cani WHERE nome LIKE ? ORDER BY nome LIMIT ? OFFSET ?",
+        conn, params=(parametro, limite, offset)
+    )
+    conn.close()
+    return df, totale
+
+def query_fts(testo, campi=None):
+    """
+    Converte il testo di ricerca in una query FTS5.
+    Le parole sono cercate anche come prefisso ('muse' trova 'museruola'),
+    "più parole tra virgolette" come frase, e '-parola' esclude i risultati.
+    `campi` limita la ricerca alle colonne indicate. Restituisce None se non c'è
+    nessun termine da cercare.
+    """
+    positivi, negativi = [], []
+    for token in re.findall(r'-?"[^"]*"|-?[^\s"]+', testo):
+        escluso = token.startswith("-")
+        parole = re.findall(r"\w+", token)
+        if not parole:
+            continue
+        termine = '"' + " ".join(parole) + '"' + ("*" if len(parole) == 1 else "")
+        (negativi if escluso else positivi).append(termine)
+    if not positivi:
+        return None
+    espressione = " AND ".join(positivi) + "".join(f" NOT {t}" for t in negativi)
+    if campi:
+        espressione = "{" + " ".join(campi) + "} : (" + espressione + ")"
+    return espressione
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def cerca_anagrafica(testo, campi, limite, versione):
+    """
+    Ricerca full-text nell'anagrafica, ordinata per rilevanza (bm25, il nome pesa di più).
+    Returns:
+        DataFrame: nome, punteggio ed estratto del testo trovato
+    """
+    query = query_fts(testo, campi)
+    if query is None:
+        return pd.DataFrame(columns=["nome", "punteggio", "estratto"])
+    conn = sqlite3.connect(DB_PATH)
+    df = pd.read_sql_query(
+        """SELECT nome,
+                  -bm25(anagrafica_fts, 10.0, 1.0, 2.0, 3.0, 1.0, 3.0, 0.5) AS punteggio,
+                  snippet(anagrafica_fts, -1, '**', '**', '…', 12) AS estratto
+           FROM anagrafica_fts WHERE anagrafica_fts MATCH ?
+           ORDER BY bm25(anagrafica_fts, 10.0, 1.0, 2.0, 3.0, 1.0, 3.0, 0.5) LIMIT ?""",
+        conn, params=(query, limite)
+    )
+    conn.close()
+    return df
+
+def tronca_testo(serie, lunghezza=TRONCA_TESTO):
+    """Accorcia i testi lunghi di una colonna, aggiungendo '…' (il testo completo si vede nel dettaglio)."""
+    serie = serie.fillna("").astype(str)
+    return serie.where(serie.str.len() <= lunghezza, serie.str.slice(0, lunghezza) + "…")
+
 def salva_anagrafica_db(dati):
-    """Salva i dati del cane nel database."""
-    conn = sqlite3.connect("canile.db")
+    """Salva i dati del cane nel database (tramite lo scrittore unico)."""
+    scrittore(DB_PATH).esegui(_scrivi_anagrafica, dati)
+
+def _scrivi_anagrafica(conn, dati):
+    """Scrittura dell'anagrafica di un cane, eseguita dallo scrittore nella sua transazione."""
     c = conn.cursor()
 
+    # Rimuove dall'indice full-text la versione precedente del cane (se presente)
+    vecchio = c.execute("SELECT rowid FROM anagrafica_cani WHERE nome=?", (dati["nome"],)).fetchone()
+    if vecchio:
+        c.execute("DELETE FROM anagrafica_fts WHERE rowid=?", (vecchio[0],))
+
     c.execute("""
         INSERT OR REPLACE INTO anagrafica_cani
         (nome, cibo, guinzaglieria, strumenti, attivita, note, tempo)
@@ -109,13 +294,17 @@ def salva_anagrafica_db(dati):
         dati["note"],
         dati["tempo"]
     ))
-
-    conn.commit()
-    conn.close()
+    c.execute("""
+        INSERT INTO anagrafica_fts
+        (rowid, nome, cibo, guinzaglieria, strumenti, attivita, note, tempo)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (c.lastrowid, dati["nome"], dati["cibo"], dati["guinzaglieria"], dati["strumenti"],
+          dati["attivita"], dati["note"], dati["tempo"]))
+    esporta.segna_revisione(conn, "anagrafica", [dati["nome"]], incrementa_versione(conn, "anagrafica"))
 
 def genera_excel_volontari():
     """Genera un file Excel con l'anagrafica dei cani."""
-    conn = sqlite3.connect("canile.db")
+    conn = sqlite3.connect(DB_PATH)
     df = pd.read_sql("SELECT * FROM anagrafica_cani", conn)
     conn.close()
 
@@ -124,10 +313,9 @@ def genera_excel_volontari():
 
     return file_excel
 
-def genera_excel_programma(programma, data_turno):
-    """Genera un file Excel con il programma completo del turno."""
-    df = pd.DataFrame(programma)
-    
+def genera_excel_programma(df, data_turno):
+    """Genera un file Excel con il programma completo del turno (da `programma_dataframe`)."""
+
     # Riordina le colonne
     cols_order = ["Orario", "Cane", "Colore_Cane", "Volontario", "Colore_Volontario", "Compatibilità", "Luogo", "Tipo", "CIBO", "GUINZAGLIERIA", "STRUMENTI", "ATTIVITÀ", "NOTE", "TEMPO"]
     # Usa solo le colonne che esistono
@@ -143,7 +331,7 @@ def genera_pdf_volontari():
     """Genera un file PDF con l'anagrafica dei cani."""
     from fpdf import FPDF
     
-    conn = sqlite3.connect("canile.db")
+    conn = sqlite3.connect(DB_PATH)
     df = pd.read_sql("SELECT * FROM anagrafica_cani", conn)
     conn.close()
 
@@ -165,79 +353,63 @@ def genera_pdf_volontari():
 
     return file_pdf
 
-def load_gsheets(sheet_name):
-    """Carica dati da Google Sheets."""
-    url = f"https://docs.google.com/spreadsheets/d/1pcFa454IT1tlykbcK-BeAU9hnIQ_D8V_UuZaKI_KtYM/gviz/tq?tqx=out:csv&sheet={sheet_name}"
+def _leggi_foglio(sheet_name):
+    """
+    Scarica un foglio da Google Sheets e lo valida (vedi validazione.py).
+    Un errore di rete o un foglio inutilizzabile non blocca gli altri fogli:
+    il foglio risulta vuoto e l'errore diventa un Problema.
+    Returns:
+        tuple: (DataFrame normalizzato, lista di Problema, True se caricato)
+    """
+    url = URL_FOGLI.format(foglio=quote(sheet_name))
     try:
         df = pd.read_csv(url)
         df.columns = [c.strip().lower() for c in df.columns]
-        if sheet_name == "Luoghi":
-            if 'automatico' not in df.columns: 
-                df['automatico'] = 'sì'
-            if 'adiacente' not in df.columns: 
-                df['adiacente'] = ''
-        if sheet_name == "Cani":
-            if 'reattività' not in df.columns: 
-                df['reattività'] = 0
-            df['reattività'] = pd.to_numeric(df['reattività'], errors='coerce').fillna(0)
-            # Aggiungi colonna colore se non presente
-            if 'colore' not in df.columns:
-                df['colore'] = 'verde'  # default
-            df['colore'] = df['colore'].str.lower().str.strip()
-        if sheet_name == "Volontari":
-            # Aggiungi colonna colore se non presente
-            if 'colore' not in df.columns:
-                df['colore'] = 'verde'  # default
-            df['colore'] = df['colore'].str.lower().str.strip()
-        return df.dropna(how='all')
-    except:
-        return pd.DataFrame()
-
-def get_livello_colore(colore):
-    """
-    Restituisce il livello numerico del colore.
-    Scala: nero (4) > rosso (3) > arancione (2) > verde (1)
-    """
-    livelli = {
-        'nero': 4,
-        'rosso': 3,
-        'arancione': 2,
-        'verde': 1
-    }
-    return livelli.get(colore.lower().strip(), 1)  # default verde se non riconosciuto
+        df, problemi = NORMALIZZATORI[sheet_name](df.dropna(how='all'))
+    except Exception as e:
+        return pd.DataFrame(), [Problema(sheet_name, None, "", f"Foglio non caricato: {e}")], False
+    return df, problemi, True
 
-def verifica_compatibilita_colore(colore_volontario, colore_cane):
+@st.cache_data(ttl=300, show_spinner=False)
+def carica_fogli():
     """
-    Verifica se un volontario può gestire un cane in base ai colori.
-    Regola: Il volontario può gestire cani del suo stesso livello o inferiore.
-    
-    Scala volontari (dal più esperto al principiante):
-    - Nero (4): può gestire tutti (nero, rosso, arancione, verde)
-    - Rosso (3): può gestire rosso, arancione, verde
-    - Arancione (2): può gestire arancione, verde
-    - Verde (1): può gestire solo verde
-    
+    Scarica in parallelo i fogli Cani, Volontari e Luoghi, li valida e ne calcola l'impronta.
+    Il risultato resta in cache per 5 minuti.
     Returns:
-        tuple: (bool compatibile, str messaggio)
+        tuple: (df_cani, df_volontari, df_luoghi, impronta, problemi, fogli non caricati)
     """
-    livello_vol = get_livello_colore(colore_volontario)
-    livello_cane = get_livello_colore(colore_cane)
-    
-    compatibile = livello_vol >= livello_cane
-    
-    if compatibile:
-        messaggio = "✅ OK"
-    else:
-        messaggio = f"⚠️ INCOMPATIBILE: serve volontario {colore_cane} o superiore"
-    
-    return compatibile, messaggio
+    with ThreadPoolExecutor(max_workers=len(FOGLI)) as pool:
+        letti = list(pool.map(_leggi_foglio, FOGLI))
+    fogli = tuple(df for df, _, _ in letti)
+    problemi = [p for _, problemi_foglio, _ in letti for p in problemi_foglio]
+    non_caricati = [nome for nome, (_, _, caricato) in zip(FOGLI, letti) if not caricato]
+    return fogli + (impronta_fogli(fogli), problemi, non_caricati)
+
+def impronta_fogli(fogli):
+    """Impronta del contenuto dei fogli: cambia solo se cambiano i dati."""
+    h = hashlib.sha1()
+    for df in fogli:
+        h.update(",".join(df.columns).encode())
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+@st.cache_resource
+def misure_avvio():
+    """Tempi di avvio del processo (import, primo render, dati), registrati alla prima esecuzione."""
+    return {}
+
+def registra_misura(nome, t_fine):
+    """Registra un tempo di avvio in secondi, solo la prima volta per processo."""
+    misure = misure_avvio()
+    misure.setdefault(nome, round(t_fine - _T_AVVIO, 3))
+    st.session_state.misure_avvio = dict(misure)
 
 def get_colore_cane(nome_cane, df_cani):
-    """Restituisce il colore di un cane."""
+    """Restituisce il colore di un cane (nero, per prudenza, se non è nel foglio)."""
     if df_cani.empty or 'colore' not in df_cani.columns:
-        return 'verde'  # default
+        return COLORE_CANE_SCONOSCIUTO
     riga = df_cani[df_cani['nome'] == nome_cane]
-    return riga.iloc[0]['colore'] if not riga.empty else 'verde'
+    return riga.iloc[0]['colore'] if not riga.empty else COLORE_CANE_SCONOSCIUTO
 
 def get_colore_volontario(nome_volontario, df_volontari):
     """Restituisce il colore/livello di un volontario."""
@@ -246,42 +418,9 @@ def get_colore_volontario(nome_volontario, df_volontari):
     riga = df_volontari[df_volontari['nome'] == nome_volontario]
     return riga.iloc[0]['colore'] if not riga.empty else 'verde'
 
-def get_reattivita_cane(nome_cane, df_cani):
-    """Restituisce il livello di reattività di un cane."""
-    if df_cani.empty or 'reattività' not in df_cani.columns: 
-        return 0
-    riga = df_cani[df_cani['nome'] == nome_cane]
-    return float(riga.iloc[0]['reattività']) if not riga.empty else 0
-
-def get_campi_adiacenti(campo, df_luoghi):
-    """Restituisce la lista dei campi adiacenti a un campo dato."""
-    if df_luoghi.empty or 'adiacente' not in df_luoghi.columns: 
-        return []
-    riga = df_luoghi[df_luoghi['nome'] == campo]
-    if not riga.empty:
-        adiacenti_str = str(riga.iloc[0]['adiacente']).strip()
-        if adiacenti_str and adiacenti_str != 'nan':
-            return [c.strip() for c in adiacenti_str.split(',') if c.strip()]
-    return []
-
-def campo_valido_per_reattivita(cane, campo, turni_attuali, ora_attuale_str, df_cani, df_luoghi):
-    """Verifica se un campo è valido per un cane considerando la reattività dei cani adiacenti."""
-    reattivita_cane_corrente = get_reattivita_cane(cane, df_cani)
-    campi_adiacenti = get_campi_adiacenti(campo, df_luoghi)
-    for turno in turni_attuali:
-        if turno["Orario"] == ora_attuale_str:
-            if turno["Luogo"] in campi_adiacenti:
-                cane_adiacente = turno["Cane"]
-                if cane_adiacente in ["TUTTI", "Da assegnare"]: 
-                    continue
-                reattivita_cane_adiacente = get_reattivita_cane(cane_adiacente, df_cani)
-                if reattivita_cane_corrente > 5 or reattivita_cane_adiacente > 5:
-                    return False
-    return True
-
 def get_anagrafica_cane(nome_cane):
     """Recupera i dati dell'anagrafica di un cane dal database."""
-    conn = sqlite3.connect('canile.db')
+    conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     
     # Prova con il nome esatto
@@ -315,77 +454,291 @@ def get_anagrafica_cane(nome_cane):
             "tempo": "N/D"
         }
 
-def salva_programma_nel_db(programma, data_sel):
-    """Salva il programma giornaliero nello storico del database."""
-    conn = sqlite3.connect('canile.db')
+def salva_programma_nel_db(programma, data_sel, versione_attesa):
+    """
+    Salva il programma giornaliero nello storico del database (tramite lo scrittore unico).
+    `versione_attesa` è la versione della bozza del giorno da cui viene il programma:
+    se nel frattempo un altro coordinatore l'ha modificata, solleva `ConflittoVersione`
+    e lo storico non viene toccato.
+    """
+    righe = [(t.orario, t.cane, v, t.luogo) for t in programma if not t.collettivo for v in t.volontari]
+    scrittore(DB_PATH).esegui(_scrivi_storico, data_sel.strftime('%Y-%m-%d'), righe, versione_attesa)
+
+def _scrivi_storico(conn, dt_str, righe, versione_attesa):
+    """Sostituisce lo storico di un giorno, eseguita dallo scrittore nella sua transazione."""
+    attuale = versione_bozza(conn, dt_str)
+    if attuale != versione_attesa:
+        raise ConflittoVersione(attuale)
+    # Un giorno di un mese già archiviato: il mese torna prima nella tabella
+    riaperto = archivio.riapri_mese(conn, CARTELLA_ARCHIVIO, dt_str[:7])
     c = conn.cursor()
-    dt_str = data_sel.strftime('%Y-%m-%d')
+    cani_prima = [cane for (cane,) in c.execute("SELECT DISTINCT cane FROM storico WHERE data=?", (dt_str,))]
     c.execute("DELETE FROM storico WHERE data=?", (dt_str,))
+    c.executemany("INSERT INTO storico VALUES (?,?,?,?,?)", [(dt_str, *r) for r in righe])
+    archivio.registra_uscite(conn, dt_str, cani_prima, [r[1] for r in righe])
+    esporta.segna_revisione(conn, "storico", [dt_str], incrementa_versione(conn, "storico"))
+    if riaperto:
+        # ...e viene subito archiviato di nuovo, con il giorno aggiornato
+        archivio.archivia_mesi_chiusi(conn, CARTELLA_ARCHIVIO)
+
+def colori_per_nome(df):
+    """Restituisce il dizionario nome -> colore di un foglio Cani o Volontari."""
+    if df.empty or 'colore' not in df.columns:
+        return {}
+    return dict(zip(df['nome'], df['colore']))
+
+def livelli_per_nome(df):
+    """Restituisce il dizionario nome -> Livello di un foglio Cani o Volontari (già validato)."""
+    if df.empty or 'livello' not in df.columns:
+        return {}
+    return dict(zip(df['nome'], map(Livello, df['livello'])))
+
+def prepara_contesto(df_cani, df_volontari, df_luoghi):
+    """
+    Prepara il contesto per `pianificatore.genera_programma`: colori e livelli,
+    reattività, adiacenze, conteggi storici per coppia cane/volontario e ultime
+    uscite di ogni cane.
+    Tutte le letture dal database avvengono qui, una volta sola.
+    """
+    reattivita = {}
+    if not df_cani.empty and 'reattività' in df_cani.columns:
+        reattivita = dict(zip(df_cani['nome'], df_cani['reattività'].astype(float)))
+
+    adiacenze = {}
+    if not df_luoghi.empty and 'adiacente' in df_luoghi.columns:
+        # Già ridotte ai luoghi esistenti da validazione.normalizza_luoghi
+        adiacenze = {nome: adiacenti.split(',') for nome, adiacenti in zip(df_luoghi['nome'], df_luoghi['adiacente'])
+                     if adiacenti}
+
+    conn = sqlite3.connect(DB_PATH)
+    storico_coppie = archivio.conteggi_coppie(conn)
+    ultime_uscite = archivio.ultime_uscite(conn)
+    conn.close()
+
+    return {
+        "colori_cani": colori_per_nome(df_cani),
+        "colori_volontari": colori_per_nome(df_volontari),
+        "livelli_cani": livelli_per_nome(df_cani),
+        "livelli_volontari": livelli_per_nome(df_volontari),
+        "reattivita": reattivita,
+        "adiacenze": adiacenze,
+        "storico_coppie": storico_coppie,
+        "ultime_uscite": ultime_uscite,
+    }
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def contesto_in_cache(_fogli, versione_roster, versione_storico):
+    """`prepara_contesto` in cache finché non cambiano i fogli (impronta) o lo storico (versione)."""
+    return prepara_contesto(*_fogli)
+
+def contesto_per_giorno(contesto, cani, giorno):
+    """
+    Il riepilogo `ultime_uscite` tiene solo due date per cane: se per qualche cane
+    sono entrambe dal giorno pianificato in poi (giorni successivi già salvati),
+    l'ultima uscita precedente viene cercata nello storico. Restituisce il contesto
+    (una copia, se corretto).
+    """
+    giorno_str = giorno.isoformat()
+    ultime = contesto["ultime_uscite"]
+    da_cercare = [c for c in cani if ultime.get(c) and not any(d and d < giorno_str for d in ultime[c])]
+    if not da_cercare:
+        return contesto
+    conn = sqlite3.connect(DB_PATH)
+    trovate = archivio.uscite_prima(conn, da_cercare, giorno_str)
+    conn.close()
+    return {**contesto, "ultime_uscite": {**ultime, **{c: (d, None) for c, d in trovate.items()}}}
+
+@st.cache_data(max_entries=GENERAZIONI_IN_CACHE, show_spinner=False)
+def genera_programma_in_cache(cani, volontari, luoghi, start_dt, end_dt, manuali, _fogli,
+                              versione_roster, versione_storico):
+    """
+    `genera_programma` in cache: la chiave comprende tutte le selezioni, gli orari
+    e i turni manuali, più l'impronta dei fogli e la versione dello storico, così
+    qualsiasi cambiamento dei dati invalida il risultato. Restano in cache le
+    ultime GENERAZIONI_IN_CACHE generazioni (le meno usate escono per prime).
+    """
+    contesto = contesto_per_giorno(contesto_in_cache(_fogli, versione_roster, versione_storico), cani, start_dt.date())
+    return genera_programma(list(cani), list(volontari), list(luoghi), start_dt, end_dt, list(manuali), contesto)
+
+def programma_dataframe(programma, df_cani, df_volontari):
+    """
+    Costruisce la tabella del programma unendo ai turni i colori correnti di cani
+    e volontari e i dati dell'anagrafica ('N/D' per i cani senza PDF).
+    """
+    contesto = {
+        "colori_cani": colori_per_nome(df_cani), "colori_volontari": colori_per_nome(df_volontari),
+        "livelli_cani": livelli_per_nome(df_cani), "livelli_volontari": livelli_per_nome(df_volontari),
+    }
+    righe = []
     for t in programma:
-        if t["Cane"] not in ["TUTTI", "Da assegnare"]:
-            vols = t["Volontario"].replace('+', ',').split(',')
-            for v in vols:
-                if v.strip():
-                    c.execute("INSERT INTO storico VALUES (?,?,?,?,?)", 
-                              (dt_str, t["Orario"], t["Cane"], v.strip(), t["Luogo"]))
-    conn.commit()
+        if t.collettivo:
+            righe.append((t.orario, t.cane, "", t.volontario, "", "", t.luogo, t.tipo))
+            continue
+        compatibile = turno_compatibile(t, contesto)
+        righe.append((
+            t.orario,
+            t.cane,
+            contesto["colori_cani"].get(t.cane, COLORE_CANE_SCONOSCIUTO).upper(),
+            t.volontario,
+            ", ".join(contesto["colori_volontari"].get(v, 'verde') for v in t.volontari).upper(),
+            "✅ OK" if compatibile else "⚠️ INCOMPATIBILE",
+            t.luogo,
+            t.tipo,
+        ))
+    df = pd.DataFrame(righe, columns=["Orario", "Cane", "Colore_Cane", "Volontario", "Colore_Volontario", "Compatibilità", "Luogo", "Tipo"])
+
+    # Unione con l'anagrafica per nome (senza distinzione maiuscole/minuscole)
+    df_ana = carica_anagrafica(versione_dati("anagrafica"))
+    df_ana = df_ana.assign(chiave=df_ana['nome'].str.upper()).drop_duplicates('chiave').set_index('chiave')
+    chiavi = df['Cane'].str.upper()
+    collettivi = pd.Series([t.collettivo for t in programma], index=df.index, dtype=bool)
+    in_anagrafica = chiavi.isin(df_ana.index)
+    campi = df_ana.reindex(chiavi)
+    for campo, colonna in zip(CAMPI_ANAGRAFICA, COLONNE_TESTO_PROGRAMMA):
+        valori = pd.Series(campi[campo].fillna("").to_numpy(), index=df.index)
+        df[colonna] = valori.where(in_anagrafica, "N/D").where(~collettivi, "")
+    return df
+
+def carica_bozza_sessione(data_str):
+    """Carica nella sessione la bozza condivisa del programma del giorno."""
+    conn = sqlite3.connect(DB_PATH)
+    versione, programma = carica_bozza(conn, data_str)
     conn.close()
+    st.session_state.programma = programma
+    st.session_state.bozza = {"data": data_str, "versione": versione}
+    st.session_state.abbinamenti_non_compatibili = []
 
-def trova_volontario_compatibile(cane, volontari_liberi, df_cani, df_volontari, conn):
+def aggiorna_programma(nuovo):
     """
-    Trova il miglior volontario compatibile per un cane.
-    Restituisce: (volontario, colore_vol, compatibile, messaggio)
+    Sostituisce il programma della sessione con `nuovo`, salvando le differenze nella
+    bozza condivisa. Se un altro coordinatore ha modificato la bozza nel frattempo,
+    la modifica non viene applicata: la bozza aggiornata viene ricaricata e si
+    restituisce False.
     """
-    colore_cane = get_colore_cane(cane, df_cani)
-    
-    # Lista di volontari con score di compatibilità
-    candidati = []
-    
-    for vol in volontari_liberi:
-        colore_vol = get_colore_volontario(vol, df_volontari)
-        compatibile, msg = verifica_compatibilita_colore(colore_vol, colore_cane)
-        
-        # Calcola score storico
-        score_storico = conn.execute(
-            "SELECT COUNT(*) FROM storico WHERE cane=? AND volontario=?", 
-            (cane, vol)
-        ).fetchone()[0]
-        
-        candidati.append({
-            'nome': vol,
-            'colore': colore_vol,
-            'compatibile': compatibile,
-            'messaggio': msg,
-            'score_storico': score_storico,
-            'livello': get_livello_colore(colore_vol)
-        })
-    
-    # Ordina: prima compatibili, poi per storico, poi per livello più alto
-    candidati.sort(key=lambda x: (
-        not x['compatibile'],  # False prima di True (compatibili prima)
-        -x['score_storico'],   # Score storico decrescente
-        -x['livello']          # Livello decrescente
-    ))
-    
-    if candidati:
-        migliore = candidati[0]
-        return migliore['nome'], migliore['colore'], migliore['compatibile'], migliore['messaggio']
-    
-    return None, None, False, "Nessun volontario disponibile"
+    bozza = st.session_state.bozza
+    try:
+        versione = salva_bozza(DB_PATH, bozza["data"], bozza["versione"], st.session_state.programma, nuovo)
+    except ConflittoVersione:
+        carica_bozza_sessione(bozza["data"])
+        st.session_state.avviso_conflitto = True
+        return False
+    st.session_state.programma = nuovo
+    bozza["versione"] = versione
+    return True
+
+def salva_storico_sessione(data_sel):
+    """
+    Salva nello storico il programma della sessione. Se la bozza è cambiata nel
+    frattempo la ricarica, prepara l'avviso di conflitto e restituisce False.
+    """
+    try:
+        salva_programma_nel_db(st.session_state.programma, data_sel, st.session_state.bozza["versione"])
+    except ConflittoVersione:
+        carica_bozza_sessione(st.session_state.bozza["data"])
+        st.session_state.avviso_conflitto = True
+        return False
+    return True
+
+@st.fragment(run_every=5)
+def controlla_modifiche_altrui():
+    """
+    Ogni 5 secondi verifica se altri coordinatori hanno modificato la bozza e applica solo i turni cambiati.
+    Durante un'esecuzione completa dell'app le modifiche vengono applicate senza
+    `st.rerun()`, così un clic sui pulsanti della stessa esecuzione non va perso;
+    solo quando gira da solo il frammento riesegue l'app per mostrarle.
+    """
+    bozza = st.session_state.bozza
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        if versione_bozza(conn, bozza["data"]) == bozza["versione"]:
+            return
+        esito = modifiche_da(conn, bozza["data"], bozza["versione"])
+    finally:
+        conn.close()
+    if esito is None:
+        carica_bozza_sessione(bozza["data"])
+        st.toast("🔔 Programma ricaricato: modificato da un altro coordinatore")
+    else:
+        versione, turni, eliminati = esito
+        st.session_state.programma = applica_a_programma(st.session_state.programma, turni, eliminati)
+        bozza["versione"] = versione
+        st.toast(f"🔔 Programma aggiornato da un altro coordinatore ({len(turni) + len(eliminati)} turni modificati)")
+    contesto_esecuzione = get_script_run_ctx()
+    if contesto_esecuzione is not None and contesto_esecuzione.fragment_ids_this_run:
+        st.rerun()
+
+@st.cache_data(max_entries=TABELLE_IN_CACHE, show_spinner=False)
+def tabella_programma(data, versione_bozza, versione_anagrafica, versione_roster, _programma, _fogli):
+    """
+    Tabella del programma con colori e anagrafica, condivisa tra le sessioni:
+    il programma in sessione è sempre la bozza del giorno a `versione_bozza`,
+    quindi i coordinatori sullo stesso giorno usano la stessa copia.
+    """
+    df_p_display = programma_dataframe(_programma, *_fogli)
+    # Colonna di stato per evidenziare la compatibilità
+    df_p_display.insert(0, "Stato", df_p_display["Compatibilità"].map(STATO_COMPATIBILITA).fillna(""))
+    return df_p_display
+
+def df_programma_corrente():
+    """Restituisce il programma in sessione come DataFrame per la visualizzazione."""
+    bozza = st.session_state.bozza
+    return tabella_programma(bozza["data"], bozza["versione"], versione_dati("anagrafica"), versione_roster,
+                             st.session_state.programma, (df_c, df_v))
+
+def controlli_paginazione(chiave, totale):
+    """
+    Disegna i controlli di paginazione (righe per pagina, numero pagina).
+    Returns:
+        tuple: (limite, offset) della pagina visibile
+    """
+    col_dim, col_pag, col_info = st.columns([1, 1, 2])
+    limite = col_dim.selectbox("Righe per pagina", RIGHE_PER_PAGINA, key=f"{chiave}_dim")
+    n_pagine = max(1, -(-totale // limite))
+    pagina = col_pag.number_input("Pagina", min_value=1, max_value=n_pagine, value=1, step=1, key=f"{chiave}_pag")
+    offset = (min(pagina, n_pagine) - 1) * limite
+    col_info.caption(f"Righe {min(offset + 1, totale)}–{min(offset + limite, totale)} di {totale} · pagina {pagina}/{n_pagine}")
+    return limite, offset
+
+def torna_prima_pagina(chiave):
+    """Callback: riporta la paginazione alla prima pagina (es. quando cambia il filtro)."""
+    st.session_state[f"{chiave}_pag"] = 1
+
+def mostra_dettaglio_testi(chiave, righe, etichette, campi):
+    """Mostra per esteso i testi lunghi di una riga scelta tra quelle della pagina."""
+    if righe.empty:
+        return
+    with st.expander("🔎 Testo completo"):
+        scelta = st.selectbox("Riga", range(len(righe)), format_func=lambda i: etichette[i], key=chiave)
+        riga = righe.iloc[scelta]
+        for campo, titolo in campi.items():
+            if campo in riga and str(riga[campo]).strip():
+                st.markdown(f"**{titolo}:** {riga[campo]}")
 
 # Inizializzazione DB e sessione
 init_db()
+archivia_se_serve()
 if 'programma' not in st.session_state: 
     st.session_state.programma = []
 if 'abbinamenti_non_compatibili' not in st.session_state:
     st.session_state.abbinamenti_non_compatibili = []
 
+# Le selezioni della vista Programma restano valide anche quando è aperta un'altra vista
+# (Streamlit scarta lo stato dei widget non disegnati nell'esecuzione corrente)
+for chiave in ("cani_turno", "volontari_turno", "luoghi_turno", "traccia_attiva"):
+    if chiave in st.session_state:
+        st.session_state[chiave] = st.session_state[chiave]
+
 # --- INTERFACCIA ---
 st.title("🐾 Programma Canile 🐕")
+registra_misura("import", _T_IMPORT)
+registra_misura("primo_render", time.perf_counter())
 
 with st.sidebar:
     st.header("⚙️ Configurazione")
     data_t = st.date_input("Data Turno", datetime.today())
+    # Il programma della sessione è la bozza condivisa del giorno selezionato
+    if st.session_state.get("bozza", {}).get("data") != data_t.strftime('%Y-%m-%d'):
+        carica_bozza_sessione(data_t.strftime('%Y-%m-%d'))
     ora_i = st.time_input("Ora Inizio", datetime.strptime("14:00", "%H:%M"))
     ora_f = st.time_input("Ora Fine", datetime.strptime("18:00", "%H:%M"))
     st.divider()
@@ -429,15 +782,14 @@ with st.sidebar:
     st.divider()
     
     # Mostra conteggio cani in anagrafica
-    df_ana = carica_anagrafica()
+    df_ana = carica_anagrafica(versione_dati("anagrafica"))
     st.metric("🐕 Cani in anagrafica", len(df_ana))
     
     # Debug: mostra quali cani sono in anagrafica
     if len(df_ana) > 0:
         with st.expander("🔍 Cani caricati in anagrafica"):
             st.write("**Nomi nel database:**")
-            for nome in df_ana['nome'].tolist():
-                st.text(f"• {nome}")
+            st.text("\n".join(f"• {nome}" for nome in df_ana['nome']))
     else:
         st.warning("⚠️ Nessun cane in anagrafica! Carica i PDF.")
     
@@ -455,20 +807,93 @@ with st.sidebar:
     **Regola**: Il volontario può gestire cani del suo livello o inferiore
     """)
 
-# Carica dati da Google Sheets
-df_c = load_gsheets("Cani")
-df_v = load_gsheets("Volontari")
-df_l = load_gsheets("Luoghi")
+    st.divider()
+    if st.button("🔄 Ricarica dati Google Sheets", use_container_width=True):
+        carica_fogli.clear()
+
+# Carica dati da Google Sheets (dopo il primo render, in parallelo e con cache)
+with st.spinner("Caricamento dati da Google Sheets..."):
+    df_c, df_v, df_l, versione_roster, problemi_fogli, fogli_non_caricati = carica_fogli()
+if fogli_non_caricati:
+    # Gli altri fogli restano utilizzabili; il risultato non resta in cache, così si riprova al prossimo giro
+    carica_fogli.clear()
+    st.error(f"❌ Impossibile caricare da Google Sheets: {', '.join(fogli_non_caricati)}")
+if problemi_fogli:
+    gravi = sum(p.grave for p in problemi_fogli)
+    with st.expander(f"⚠️ {len(problemi_fogli)} problemi nei fogli Google ({gravi} da correggere)", expanded=gravi > 0):
+        st.dataframe(
+            pd.DataFrame([
+                {"Foglio": p.foglio, "Riga": p.riga, "Nome": p.nome, "Problema": p.messaggio,
+                 "Gravità": "🟥 da correggere" if p.grave else "🟨 avviso"}
+                for p in problemi_fogli
+            ]),
+            hide_index=True, use_container_width=True
+        )
+registra_misura("dati", time.perf_counter())
+
+with st.sidebar:
+    with st.expander("⏱️ Tempi di avvio"):
+        for nome, secondi in st.session_state.misure_avvio.items():
+            st.text(f"{nome}: {secondi:.3f} s")
+
+def mostra_traccia(eventi):
+    """Mostra la traccia dell'ultima generazione (eventi di `pianificatore.genera_programma`)."""
+    if not eventi:
+        st.info("ℹ️ Nessuna traccia: attiva la registrazione e genera il programma")
+        return
+    fasce = [e for e in eventi if e["evento"] == "fascia"]
+    assegnazioni = [e for e in eventi if e["evento"] == "assegnazione"]
+    col_t1, col_t2, col_t3 = st.columns(3)
+    col_t1.metric("Eventi", len(eventi))
+    col_t2.metric("Assegnazioni", len(assegnazioni))
+    col_t3.metric("Tempo nelle fasce", f"{sum(e['ms'] for e in fasce):.1f} ms")
+    if len(eventi) == TRACCIA_MAX_EVENTI:
+        st.caption(f"Traccia piena: sono mostrati solo gli ultimi {TRACCIA_MAX_EVENTI} eventi")
+
+    if fasce:
+        st.markdown("**Tempo per fascia oraria**")
+        st.bar_chart(pd.DataFrame({"ms": [e["ms"] for e in fasce]}, index=[e["orario"] for e in fasce]))
 
-# Tabs principali
-tab_prog, tab_ana, tab_stats, tab_colori = st.tabs(["📅 Programma", "📋 Anagrafica Cani", "📊 Statistiche", "🎨 Gestione Colori"])
+    tipi = sorted({e["evento"] for e in eventi})
+    scelti = st.multiselect("Tipi di evento", tipi, default=tipi, key="traccia_tipi")
+    st.dataframe(
+        pd.DataFrame(
+            [{c: e.get(c, "") for c in ("evento", "orario", "cane", "luogo", "volontario", "dettaglio")}
+             for e in eventi if e["evento"] in scelti]
+        ),
+        hide_index=True, use_container_width=True
+    )
+
+    if assegnazioni:
+        scelta = st.selectbox(
+            "Candidati di un'assegnazione", range(len(assegnazioni)),
+            format_func=lambda i: f"{assegnazioni[i]['orario']} - {assegnazioni[i]['cane']} → {assegnazioni[i]['volontario']}",
+            key="traccia_assegnazione"
+        )
+        st.dataframe(pd.DataFrame(assegnazioni[scelta]["candidati"]), hide_index=True, use_container_width=True)
 
-with tab_prog:
+def vista_programma():
+    """Vista Programma: selezione, generazione e visualizzazione dei turni."""
     st.header("Pianificazione Turni")
+    controlla_modifiche_altrui()
+    if st.session_state.pop("avviso_conflitto", False):
+        st.warning("⚠️ Un altro coordinatore ha modificato il programma nel frattempo: è stato ricaricato, ripeti l'operazione.")
     
-    c_p = st.multiselect("🐕 Cani in turno", df_c['nome'].tolist() if not df_c.empty else [])
-    v_p = st.multiselect("👤 Volontari presenti", df_v['nome'].tolist() if not df_v.empty else [])
-    l_p = st.multiselect("📍 Luoghi disponibili", df_l['nome'].tolist() if not df_l.empty else [])
+    opzioni_cani = df_c['nome'].tolist() if not df_c.empty else []
+    filtro_ricerca = st.session_state.get("filtro_cani_ricerca")
+    if filtro_ricerca:
+        col_filtro, col_rimuovi = st.columns([3, 1])
+        col_filtro.info(f"🔎 Cani filtrati dalla ricerca in anagrafica: «{filtro_ricerca['testo']}»")
+        if col_rimuovi.button("✖ Rimuovi filtro", use_container_width=True):
+            del st.session_state.filtro_cani_ricerca
+            st.rerun()
+        # I cani già selezionati restano tra le opzioni
+        selezionati = set(st.session_state.get("cani_turno", []))
+        opzioni_cani = [c for c in opzioni_cani if str(c).upper() in filtro_ricerca["nomi"] or c in selezionati]
+    
+    c_p = st.multiselect("🐕 Cani in turno", opzioni_cani, key="cani_turno")
+    v_p = st.multiselect("👤 Volontari presenti", df_v['nome'].tolist() if not df_v.empty else [], key="volontari_turno")
+    l_p = st.multiselect("📍 Luoghi disponibili", df_l['nome'].tolist() if not df_l.empty else [], key="luoghi_turno")
 
     with st.expander("✏️ Inserimento Manuale Turno"):
         col1, col2 = st.columns(2)
@@ -514,27 +939,10 @@ with tab_prog:
                 if incompatibilita:
                     st.warning(f"⚠️ ATTENZIONE: I seguenti volontari NON sono compatibili con il cane {m_cane} ({colore_cane}): {', '.join(incompatibilita)}")
                 
-                volontari_str = ", ".join(m_vols)
-                colori_vol_str = ", ".join([get_colore_volontario(v, df_v) for v in m_vols])
-                compatibilita_str = "⚠️ INCOMPATIBILE" if incompatibilita else "✅ OK"
-                
-                st.session_state.programma.append({
-                    "Orario": m_ora.strftime('%H:%M'), 
-                    "Cane": m_cane,
-                    "Colore_Cane": colore_cane.upper(),
-                    "Volontario": volontari_str, 
-                    "Colore_Volontario": colori_vol_str.upper(),
-                    "Compatibilità": compatibilita_str,
-                    "Luogo": m_luo, 
-                    "Tipo": "Manuale",
-                    "Inizio_Sort": m_ora.strftime('%H:%M'),
-                    "CIBO": ana_data["cibo"],
-                    "GUINZAGLIERIA": ana_data["guinzaglieria"],
-                    "STRUMENTI": ana_data["strumenti"],
-                    "ATTIVITÀ": ana_data["attivita"],
-                    "NOTE": ana_data["note"],
-                    "TEMPO": ana_data["tempo"]
-                })
+                nuovo = list(st.session_state.programma)
+                inserisci_turno(nuovo, Turno(m_ora.strftime('%H:%M'), m_cane, tuple(m_vols), m_luo, "Manuale"))
+                if not aggiorna_programma(nuovo):
+                    st.rerun()
                 
                 if incompatibilita:
                     st.error(f"❌ Turno aggiunto con INCOMPATIBILITÀ: {m_cane} alle {m_ora.strftime('%H:%M')}")
@@ -550,125 +958,36 @@ with tab_prog:
     
     if c1.button("🤖 Genera / Completa Automatico", use_container_width=True):
         # Verifica se ci sono cani in anagrafica
-        df_ana_check = carica_anagrafica()
+        df_ana_check = carica_anagrafica(versione_dati("anagrafica"))
         cani_mancanti = [c for c in c_p if c.upper() not in df_ana_check['nome'].str.upper().tolist()]
         
         if cani_mancanti:
             st.warning(f"⚠️ I seguenti cani NON sono presenti nell'anagrafica PDF: {', '.join(cani_mancanti)}")
             st.info("💡 Carica i PDF di questi cani dalla sidebar per avere le informazioni complete nel programma")
         
-        conn = sqlite3.connect('canile.db')
-        conn.row_factory = sqlite3.Row
         start_dt = datetime.combine(data_t, ora_i)
         end_dt = datetime.combine(data_t, ora_f)
-        pasti_dt = end_dt - timedelta(minutes=30)
-        
-        manuali = [r for r in st.session_state.programma if r.get("Tipo") == "Manuale"]
-        
-        # Reset lista abbinamenti non compatibili
-        st.session_state.abbinamenti_non_compatibili = []
         
-        # Briefing iniziale (senza dati anagrafica perché è per tutti)
-        st.session_state.programma = [{
-            "Orario": start_dt.strftime('%H:%M'), 
-            "Cane": "TUTTI",
-            "Colore_Cane": "",
-            "Volontario": "TUTTI",
-            "Colore_Volontario": "",
-            "Compatibilità": "",
-            "Luogo": "Ufficio", 
-            "Tipo": "Briefing", 
-            "Inizio_Sort": start_dt.strftime('%H:%M'),
-            "CIBO": "",
-            "GUINZAGLIERIA": "",
-            "STRUMENTI": "",
-            "ATTIVITÀ": "",
-            "NOTE": "",
-            "TEMPO": ""
-        }]
-        
-        cani_fatti = [m["Cane"] for m in manuali]
-        cani_restanti = [c for c in c_p if c not in cani_fatti]
-        curr_t = start_dt + timedelta(minutes=15)
-        luoghi_ok = df_l[(df_l['nome'].isin(l_p)) & (df_l['automatico'].str.lower() == 'sì')]['nome'].tolist()
-
-        while cani_restanti and curr_t < pasti_dt:
-            ora_s = curr_t.strftime('%H:%M')
-            v_liberi = [v for v in v_p if v not in [vv for m in manuali if m["Orario"]==ora_s for vv in m["Volontario"].split(",")]]
-            l_liberi = [l for l in luoghi_ok if l not in [m["Luogo"] for m in manuali if m["Orario"]==ora_s]]
-            
-            for _ in range(min(len(cani_restanti), len(l_liberi))):
-                if not v_liberi: 
-                    break
-                for idx, cane in enumerate(cani_restanti):
-                    if l_liberi and campo_valido_per_reattivita(cane, l_liberi[0], st.session_state.programma + manuali, ora_s, df_c, df_l):
-                        campo_scelto = l_liberi.pop(0)
-                        cani_restanti.pop(idx)
-                        
-                        # Trova volontario compatibile con controllo colori
-                        volontario_scelto, colore_vol, compatibile, msg = trova_volontario_compatibile(
-                            cane, v_liberi, df_c, df_v, conn
-                        )
-                        
-                        if volontario_scelto:
-                            v_liberi.remove(volontario_scelto)
-                            
-                            # Recupera dati anagrafica del cane
-                            ana_data = get_anagrafica_cane(cane)
-                            colore_cane = get_colore_cane(cane, df_c)
-                            
-                            # Traccia abbinamenti non compatibili
-                            if not compatibile:
-                                st.session_state.abbinamenti_non_compatibili.append({
-                                    'orario': ora_s,
-                                    'cane': cane,
-                                    'colore_cane': colore_cane,
-                                    'volontario': volontario_scelto,
-                                    'colore_volontario': colore_vol,
-                                    'messaggio': msg
-                                })
-                            
-                            st.session_state.programma.append({
-                                "Orario": ora_s, 
-                                "Cane": cane,
-                                "Colore_Cane": colore_cane.upper(),
-                                "Volontario": volontario_scelto,
-                                "Colore_Volontario": colore_vol.upper(),
-                                "Compatibilità": "✅ OK" if compatibile else "⚠️ INCOMPATIBILE",
-                                "Luogo": campo_scelto, 
-                                "Tipo": "Auto", 
-                                "Inizio_Sort": ora_s,
-                                "CIBO": ana_data["cibo"],
-                                "GUINZAGLIERIA": ana_data["guinzaglieria"],
-                                "STRUMENTI": ana_data["strumenti"],
-                                "ATTIVITÀ": ana_data["attivita"],
-                                "NOTE": ana_data["note"],
-                                "TEMPO": ana_data["tempo"]
-                            })
-                        break
-            curr_t += timedelta(minutes=45)
-        
-        st.session_state.programma.extend(manuali)
-        
-        # Pasti finali (senza dati anagrafica perché è per tutti)
-        st.session_state.programma.append({
-            "Orario": pasti_dt.strftime('%H:%M'), 
-            "Cane": "TUTTI",
-            "Colore_Cane": "",
-            "Volontario": "TUTTI",
-            "Colore_Volontario": "",
-            "Compatibilità": "",
-            "Luogo": "Box", 
-            "Tipo": "Pasti", 
-            "Inizio_Sort": pasti_dt.strftime('%H:%M'),
-            "CIBO": "",
-            "GUINZAGLIERIA": "",
-            "STRUMENTI": "",
-            "ATTIVITÀ": "",
-            "NOTE": "",
-            "TEMPO": ""
-        })
-        conn.close()
+        manuali = [t for t in st.session_state.programma if t.tipo == "Manuale"]
+        luoghi_ok = df_l[(df_l['nome'].isin(l_p)) & (df_l['automatico'] == 'sì')]['nome'].tolist()
+        if st.session_state.get("traccia_attiva"):
+            # Con la traccia la generazione viene sempre rifatta (niente cache)
+            traccia = nuova_traccia()
+            programma, non_compatibili = genera_programma(
+                list(c_p), list(v_p), luoghi_ok, start_dt, end_dt, manuali,
+                contesto_per_giorno(contesto_in_cache((df_c, df_v, df_l), versione_roster, versione_dati("storico")),
+                                    c_p, start_dt.date()),
+                traccia=traccia
+            )
+            st.session_state.traccia = list(traccia)
+        else:
+            programma, non_compatibili = genera_programma_in_cache(
+                tuple(c_p), tuple(v_p), tuple(luoghi_ok), start_dt, end_dt, tuple(manuali),
+                (df_c, df_v, df_l), versione_roster, versione_dati("storico")
+            )
+        if not aggiorna_programma(programma):
+            st.rerun()
+        st.session_state.abbinamenti_non_compatibili = non_compatibili
         
         # Mostra avviso se ci sono incompatibilità
         if st.session_state.abbinamenti_non_compatibili:
@@ -681,7 +1000,8 @@ with tab_prog:
     if c2.button("💾 Conferma e Salva Storico", type="primary", use_container_width=True):
         if st.session_state.programma:
             # Controlla se ci sono incompatibilità
-            incompatibili = [t for t in st.session_state.programma if t.get("Compatibilità") == "⚠️ INCOMPATIBILE"]
+            df_prog = df_programma_corrente()
+            incompatibili = df_prog[df_prog["Compatibilità"] == "⚠️ INCOMPATIBILE"].to_dict("records")
             
             if incompatibili:
                 st.error(f"⚠️ ATTENZIONE: Ci sono {len(incompatibili)} abbinamenti incompatibili nel programma!")
@@ -690,22 +1010,70 @@ with tab_prog:
                         st.warning(f"⏰ {t['Orario']} - 🐕 {t['Cane']} ({t['Colore_Cane']}) + 👤 {t['Volontario']} ({t['Colore_Volontario']})")
                 
                 if st.button("✅ Conferma comunque e salva", type="primary"):
-                    salva_programma_nel_db(st.session_state.programma, data_t)
-                    st.success("✅ Programma salvato con successo nello storico (con incompatibilità)!")
-            else:
-                salva_programma_nel_db(st.session_state.programma, data_t)
+                    if salva_storico_sessione(data_t):
+                        st.success("✅ Programma salvato con successo nello storico (con incompatibilità)!")
+                    else:
+                        st.rerun()
+            elif salva_storico_sessione(data_t):
                 st.success("✅ Programma salvato con successo nello storico!")
+            else:
+                st.rerun()
         else:
             st.warning("⚠️ Nessun programma da salvare")
 
     if c3.button("🗑️ Svuota Tutto", use_container_width=True):
-        st.session_state.programma = []
-        st.session_state.abbinamenti_non_compatibili = []
-        st.success("✅ Programma svuotato")
+        if aggiorna_programma([]):
+            st.session_state.abbinamenti_non_compatibili = []
+            st.success("✅ Programma svuotato")
         st.rerun()
 
+    with st.expander("🎲 Simulazione Assenze Volontari"):
+        st.caption("Stima quanto è robusto il programma se alcuni volontari non si presentano")
+        col_sim1, col_sim2 = st.columns(2)
+        prob_assenza = col_sim1.slider("Probabilità di assenza per volontario (%)", 5, 50, 15, step=5)
+        iterazioni = col_sim2.number_input("Scenari da simulare", min_value=100, max_value=20000, value=2000, step=100)
+
+        if st.button("▶️ Avvia Simulazione", use_container_width=True):
+            if not c_p or not v_p or not l_p:
+                st.warning("⚠️ Seleziona cani, volontari e luoghi")
+            else:
+                manuali = [t for t in st.session_state.programma if t.tipo == "Manuale"]
+                luoghi_ok = df_l[(df_l['nome'].isin(l_p)) & (df_l['automatico'] == 'sì')]['nome'].tolist()
+                with st.spinner("Simulazione in corso..."):
+                    st.session_state.simulazione = simula_assenze(
+                        c_p, v_p, luoghi_ok,
+                        datetime.combine(data_t, ora_i), datetime.combine(data_t, ora_f),
+                        manuali,
+                        contesto_per_giorno(contesto_in_cache((df_c, df_v, df_l), versione_roster, versione_dati("storico")),
+                                            c_p, data_t),
+                        prob_assenza=prob_assenza / 100, iterazioni=int(iterazioni)
+                    )
+
+        sim = st.session_state.get('simulazione')
+        if sim:
+            col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+            col_r1.metric("Cani portati (media)", f"{sim['media_cani']:.1f} / {sim['cani_totali']}")
+            col_r2.metric("Caso pessimo 10%", sim['p10_cani'])
+            col_r3.metric("Caso peggiore", sim['min_cani'])
+            col_r4.metric("Incompatibili (media)", f"{sim['media_incompatibili']:.2f}")
+
+            col_g1, col_g2 = st.columns(2)
+            col_g1.markdown("**Distribuzione cani portati**")
+            col_g1.bar_chart(pd.Series(sim['cani_portati']).value_counts().sort_index())
+            col_g2.markdown("**Distribuzione abbinamenti incompatibili**")
+            col_g2.bar_chart(pd.Series(sim['incompatibili']).value_counts().sort_index())
+
+            if sim['criticita']:
+                st.markdown("**Volontari più critici** (cani persi in media quando assenti)")
+                st.dataframe(pd.DataFrame(sim['criticita']), hide_index=True, use_container_width=True)
+
+    with st.expander("🔍 Traccia dello Scheduler"):
+        st.caption("Registra le decisioni della generazione automatica: candidati, punteggi, vincoli e tempi per fascia")
+        st.toggle("Registra la traccia alla prossima generazione", key="traccia_attiva")
+        mostra_traccia(st.session_state.get("traccia", []))
+
     st.divider()
-    
+
     # Mostra alert per abbinamenti non compatibili
     if st.session_state.abbinamenti_non_compatibili:
         st.error(f"⚠️ ATTENZIONE: {len(st.session_state.abbinamenti_non_compatibili)} ABBINAMENTI NON COMPATIBILI!")
@@ -729,32 +1097,27 @@ with tab_prog:
 
     if st.session_state.programma:
         st.subheader("📋 Programma Corrente")
-        df_p = pd.DataFrame(st.session_state.programma).sort_values("Inizio_Sort")
+        df_p_display = df_programma_corrente()
         
-        # Riordina le colonne per una migliore visualizzazione
-        cols_order = ["Orario", "Cane", "Colore_Cane", "Volontario", "Colore_Volontario", "Compatibilità", "Luogo", "Tipo", "CIBO", "GUINZAGLIERIA", "STRUMENTI", "ATTIVITÀ", "NOTE", "TEMPO"]
-        cols_order = [c for c in cols_order if c in df_p.columns]
-        df_p_display = df_p[cols_order]
-        
-        # Formatta le celle con colori di sfondo
-        def highlight_compatibility(val):
-            if val == "⚠️ INCOMPATIBILE":
-                return 'background-color: #ffcccc; font-weight: bold;'
-            elif val == "✅ OK":
-                return 'background-color: #ccffcc;'
-            return ''
-        
-        # Applica lo stile
-        styled_df = df_p_display.style.applymap(
-            highlight_compatibility, 
-            subset=['Compatibilità'] if 'Compatibilità' in df_p_display.columns else []
-        )
+        # Filtro e paginazione: al browser viene inviata solo la pagina visibile
+        filtro = st.text_input("🔎 Filtra (cane, volontario, luogo)", key="filtro_programma",
+                               on_change=torna_prima_pagina, args=("pag_programma",)).strip().lower()
+        if filtro:
+            testo = (df_p_display["Cane"] + " " + df_p_display["Volontario"] + " " + df_p_display["Luogo"]).str.lower()
+            df_p_display = df_p_display[testo.str.contains(filtro, regex=False)]
+        limite, offset = controlli_paginazione("pag_programma", len(df_p_display))
+        pagina = df_p_display.iloc[offset:offset + limite]
+        pagina_vista = pagina.copy()
+        for col in COLONNE_TESTO_PROGRAMMA:
+            if col in pagina_vista.columns:
+                pagina_vista[col] = tronca_testo(pagina_vista[col])
         
         st.dataframe(
-            styled_df, 
+            pagina_vista, 
             use_container_width=True, 
             hide_index=True,
             column_config={
+                "Stato": st.column_config.TextColumn("", width="small"),
                 "Orario": st.column_config.TextColumn("Orario", width="small"),
                 "Cane": st.column_config.TextColumn("Cane", width="medium"),
                 "Colore_Cane": st.column_config.TextColumn("🎨 Livello Cane", width="small"),
@@ -771,14 +1134,21 @@ with tab_prog:
                 "TEMPO": st.column_config.TextColumn("TEMPO", width="small")
             }
         )
+        mostra_dettaglio_testi(
+            "dettaglio_programma",
+            pagina,
+            [f"{r.Orario} – {r.Cane}" for r in pagina.itertuples()],
+            {col: col for col in COLONNE_TESTO_PROGRAMMA}
+        )
         
         # Statistiche rapide
         st.divider()
         col_stat1, col_stat2, col_stat3 = st.columns(3)
         
-        turni_cani = [t for t in st.session_state.programma if t['Cane'] not in ['TUTTI', 'Da assegnare']]
-        incompatibili_count = len([t for t in turni_cani if t.get('Compatibilità') == '⚠️ INCOMPATIBILE'])
-        compatibili_count = len([t for t in turni_cani if t.get('Compatibilità') == '✅ OK'])
+        df_completo = df_programma_corrente()
+        turni_cani = [t for t in st.session_state.programma if not t.collettivo]
+        incompatibili_count = int((df_completo['Compatibilità'] == '⚠️ INCOMPATIBILE').sum())
+        compatibili_count = int((df_completo['Compatibilità'] == '✅ OK').sum())
         
         col_stat1.metric("Turni Totali", len(turni_cani))
         col_stat2.metric("✅ Compatibili", compatibili_count)
@@ -788,7 +1158,7 @@ with tab_prog:
         st.divider()
         col_exp1, col_exp2 = st.columns(2)
         if col_exp1.button("📊 Esporta Programma in Excel", use_container_width=True):
-            excel_file = genera_excel_programma(st.session_state.programma, data_t)
+            excel_file = genera_excel_programma(df_programma_corrente(), data_t)
             with open(excel_file, "rb") as f:
                 st.download_button(
                     "⬇️ Scarica Programma Excel",
@@ -797,23 +1167,75 @@ with tab_prog:
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     use_container_width=True
                 )
+        if col_exp2.button("📦 Pacchetti Briefing Volontari", use_container_width=True):
+            with st.spinner("Generazione PDF ed Excel per ogni volontario..."):
+                # Schede unite per nome del cane (mai per posizione della riga)
+                schede_cani = {r["Cane"]: r for r in df_completo.to_dict("records")}
+                scalette, profili = turni_per_volontario(st.session_state.programma, schede_cani)
+                pacchetto = genera_pacchetto_briefing(scalette, profili, data_t.strftime('%Y-%m-%d'))
+            col_exp2.download_button(
+                f"⬇️ Scarica ZIP ({len(scalette)} volontari)",
+                pacchetto,
+                file_name=f"briefing_{data_t.strftime('%Y%m%d')}.zip",
+                mime="application/zip",
+                use_container_width=True
+            )
     else:
         st.info("ℹ️ Nessun turno programmato. Usa 'Genera Automatico' o 'Inserimento Manuale'")
 
-with tab_ana:
+def vista_anagrafica():
+    """Vista Anagrafica: dati dei cani caricati da PDF."""
     st.header("📋 Anagrafica Cani")
     st.markdown("*Database completo dei cani caricati tramite PDF*")
     
-    conn = sqlite3.connect('canile.db')
-    df_db = pd.read_sql_query("SELECT * FROM anagrafica_cani", conn)
-    conn.close()
+    versione = versione_dati("anagrafica")
+    _, n_cani = carica_pagina_anagrafica("", 1, 0, versione)
     
-    if not df_db.empty:
-        st.success(f"✅ {len(df_db)} cani in anagrafica")
+    if n_cani:
+        st.success(f"✅ {n_cani} cani in anagrafica")
+        
+        with st.expander("🔎 Ricerca nel testo delle schede", expanded=bool(st.session_state.get("ricerca_fts"))):
+            st.caption('Es. `museruola`, `-gatti`, `"no contatto"`. Le parole valgono anche come inizio di parola.')
+            col_q, col_campi = st.columns([2, 1])
+            testo = col_q.text_input("Cerca", key="ricerca_fts")
+            campi = col_campi.multiselect(
+                "Solo nei campi", ["nome"] + CAMPI_ANAGRAFICA, key="ricerca_fts_campi",
+                format_func=lambda c: "Nome" if c == "nome" else ("ATTIVITÀ" if c == "attivita" else c.upper())
+            )
+            if testo.strip():
+                t_ricerca = time.perf_counter()
+                risultati = cerca_anagrafica(testo, tuple(campi), 200, versione)
+                durata_ms = (time.perf_counter() - t_ricerca) * 1000
+                st.caption(f"{len(risultati)} risultati in {durata_ms:.1f} ms")
+                if not risultati.empty:
+                    st.dataframe(
+                        risultati, use_container_width=True, hide_index=True,
+                        column_config={
+                            "nome": st.column_config.TextColumn("Nome", width="medium"),
+                            "punteggio": st.column_config.NumberColumn("Rilevanza", format="%.2f", width="small"),
+                            "estratto": st.column_config.TextColumn("Estratto", width="large"),
+                        }
+                    )
+                    if st.button("🐕 Usa questi cani come filtro nel Programma", use_container_width=True):
+                        st.session_state.filtro_cani_ricerca = {
+                            "testo": testo.strip(),
+                            "nomi": set(risultati["nome"].str.upper()),
+                        }
+                        st.success("✅ Filtro applicato alla selezione dei cani nel Programma")
+        
+        # Filtro e paginazione lato database: si legge e si invia solo la pagina visibile
+        filtro = st.text_input("🔎 Filtra per nome", key="filtro_anagrafica",
+                               on_change=torna_prima_pagina, args=("pag_anagrafica",)).strip()
+        _, totale = carica_pagina_anagrafica(filtro, 1, 0, versione)
+        limite, offset = controlli_paginazione("pag_anagrafica", totale)
+        pagina, _ = carica_pagina_anagrafica(filtro, limite, offset, versione)
+        pagina_vista = pagina.copy()
+        for campo in CAMPI_ANAGRAFICA:
+            pagina_vista[campo] = tronca_testo(pagina_vista[campo])
         
         # Mostra le colonne strutturate dal PDF
         st.dataframe(
-            df_db, 
+            pagina_vista, 
             use_container_width=True, 
             hide_index=True,
             column_config={
@@ -826,6 +1248,12 @@ with tab_ana:
                 "tempo": st.column_config.TextColumn("TEMPO", width="small")
             }
         )
+        mostra_dettaglio_testi(
+            "dettaglio_anagrafica",
+            pagina,
+            pagina["nome"].tolist(),
+            {campo: "ATTIVITÀ" if campo == "attivita" else campo.upper() for campo in CAMPI_ANAGRAFICA}
+        )
         
         st.divider()
         
@@ -868,16 +1296,20 @@ with tab_ana:
         3. Clicca su "Aggiorna anagrafica da PDF"
         """)
 
-with tab_stats:
+def vista_statistiche():
+    """Vista Statistiche: attività storiche nel periodo."""
     st.header("📊 Statistiche Storiche")
     
-    conn = sqlite3.connect('canile.db')
     col_a, col_b = st.columns(2)
     d_ini = col_a.date_input("Inizio Periodo", datetime.today() - timedelta(days=30))
     d_end = col_b.date_input("Fine Periodo", datetime.today())
     
-    query = "SELECT * FROM storico WHERE data BETWEEN ? AND ?"
-    df_h = pd.read_sql_query(query, conn, params=(d_ini.strftime('%Y-%m-%d'), d_end.strftime('%Y-%m-%d')))
+    df_h = carica_storico(d_ini.strftime('%Y-%m-%d'), d_end.strftime('%Y-%m-%d'), versione_dati("storico"))
+    conn = sqlite3.connect(DB_PATH)
+    mesi = archivio.mesi_archiviati(conn)
+    conn.close()
+    if mesi and d_ini.strftime('%Y-%m') <= mesi[-1][0]:
+        st.caption(f"📦 Il periodo comprende mesi archiviati (archivio fino a {mesi[-1][0]}): caricamento più lento")
     
     if not df_h.empty:
         st.success(f"✅ Trovate {len(df_h)} attività nel periodo selezionato")
@@ -900,10 +1332,9 @@ with tab_stats:
         st.dataframe(res, hide_index=True, use_container_width=True)
     else:
         st.warning("⚠️ Nessun dato presente per le date selezionate.")
-    
-    conn.close()
 
-with tab_colori:
+def vista_colori():
+    """Vista Gestione Colori: livelli di cani e volontari e verifica compatibilità."""
     st.header("🎨 Gestione Colori Cani e Volontari")
     
     st.markdown("""
@@ -1006,3 +1437,13 @@ with tab_colori:
     
     Valori accettati: `nero`, `rosso`, `arancione`, `verde` (minuscolo o maiuscolo)
     """)
+
+# Navigazione: viene eseguita solo la vista selezionata
+VISTE = {
+    "📅 Programma": vista_programma,
+    "📋 Anagrafica Cani": vista_anagrafica,
+    "📊 Statistiche": vista_statistiche,
+    "🎨 Gestione Colori": vista_colori,
+}
+vista = st.radio("Vista", list(VISTE), horizontal=True, label_visibility="collapsed", key="vista")
+VISTE[vista]()
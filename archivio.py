@@ -0,0 +1,267 @@
+"""
+Archiviazione per mese dello storico.
+
+La tabella `storico` contiene solo i mesi recenti (MESI_CALDI, mese corrente
+compreso). I mesi chiusi più vecchi vengono spostati in un file CSV compresso
+per mese (`storico_AAAA-MM_<id>.csv.gz`), registrato nella tabella
+`archivio_mesi`. Ogni archiviazione scrive un file nuovo e non sovrascrive mai
+quello in uso: se la transazione viene annullata, `archivio_mesi` punta ancora
+al file precedente, intatto. I file non più registrati vengono rimossi da
+`pulisci_archivi`.
+Per lo scheduler, i conteggi delle coppie cane/volontario dei mesi archiviati
+restano in `storico_coppie_archivio`, così non serve mai leggere gli archivi.
+
+Le letture per periodo (`leggi_storico`) aprono gli archivi solo se il
+periodo richiesto arriva a quei mesi. Salvare un giorno di un mese archiviato
+lo riporta prima nella tabella (`riapri_mese`); l'app lo archivia di nuovo
+subito dopo il salvataggio. Il passaggio di archiviazione gira una volta al
+giorno, così anche un server sempre acceso sposta i mesi appena chiusi.
+
+La tabella `ultime_uscite` riassume, per ogni cane, le ultime due date in cui
+è uscito: è aggiornata a ogni salvataggio (`registra_uscite`) e permette allo
+scheduler di sapere da quanti giorni un cane non esce senza leggere lo storico.
+
+Le funzioni che scrivono ricevono la connessione dello scrittore unico
+(`bozze.scrittore`) e vengono eseguite nella sua transazione.
+"""
+import csv
+import gzip
+import os
+import sqlite3
+import time
+from datetime import date
+from uuid import uuid4
+
+import pandas as pd
+
+COLONNE = ["data", "inizio", "cane", "volontario", "luogo"]
+MESI_CALDI = 3
+# Un file non registrato più recente di così può appartenere a una transazione in corso
+ATTESA_PULIZIA = 3600
+
+
+def cartella_archivio(percorso_db):
+    """Cartella degli archivi mensili, accanto al database."""
+    return os.path.join(os.path.dirname(percorso_db), "archivio_storico")
+
+
+def init_schema(conn):
+    """Crea gli indici dello storico e le tabelle dell'archivio."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_storico_data ON storico (data)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_storico_coppia ON storico (cane, volontario)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_storico_cane_data ON storico (cane, data)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS archivio_mesi
+                    (mese TEXT PRIMARY KEY, file TEXT NOT NULL, righe INTEGER NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS storico_coppie_archivio
+                    (cane TEXT, volontario TEXT, conteggio INTEGER NOT NULL,
+                     PRIMARY KEY (cane, volontario))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS ultime_uscite
+                    (cane TEXT PRIMARY KEY, ultima TEXT NOT NULL, precedente TEXT)''')
+
+
+def primo_mese_caldo(oggi=None, mesi_caldi=MESI_CALDI):
+    """Primo mese ('AAAA-MM') che resta nella tabella storico."""
+    oggi = oggi or date.today()
+    indice = oggi.year * 12 + oggi.month - 1 - (mesi_caldi - 1)
+    return f"{indice // 12:04d}-{indice % 12 + 1:02d}"
+
+
+def _percorso_nuovo(cartella, mese):
+    return os.path.join(cartella, f"storico_{mese}_{uuid4().hex[:8]}.csv.gz")
+
+
+def leggi_file(percorso):
+    """Legge un file di archivio mensile (tutte le colonne come testo)."""
+    with gzip.open(percorso, "rt", newline="", encoding="utf-8") as f:
+        return pd.read_csv(f, dtype=str, keep_default_na=False)
+
+
+def _aggiorna_coppie(conn, conteggi, segno):
+    conn.executemany(
+        '''INSERT INTO storico_coppie_archivio (cane, volontario, conteggio) VALUES (?, ?, ?)
+           ON CONFLICT(cane, volontario) DO UPDATE SET conteggio = conteggio + excluded.conteggio''',
+        [(cane, vol, segno * n) for cane, vol, n in conteggi]
+    )
+    conn.execute("DELETE FROM storico_coppie_archivio WHERE conteggio <= 0")
+
+
+def archivia_mesi_chiusi(conn, cartella, oggi=None, mesi_caldi=MESI_CALDI):
+    """
+    Sposta negli archivi i mesi precedenti alla finestra calda.
+    Ogni mese va in un file nuovo, registrato in `archivio_mesi` nella stessa
+    transazione che cancella le righe: se la transazione fallisce, tabella e
+    registro restano com'erano e puntano ancora ai file precedenti.
+    Returns:
+        list: i mesi archiviati
+    """
+    limite = primo_mese_caldo(oggi, mesi_caldi)
+    mesi = [m for (m,) in conn.execute(
+        "SELECT DISTINCT substr(data, 1, 7) FROM storico WHERE data < ? ORDER BY 1", (f"{limite}-01",)
+    )]
+    if not mesi:
+        return []
+    os.makedirs(cartella, exist_ok=True)
+    for mese in mesi:
+        intervallo = (f"{mese}-01", f"{mese}-31")
+        righe = conn.execute(
+            "SELECT * FROM storico WHERE data BETWEEN ? AND ? ORDER BY data, inizio", intervallo
+        ).fetchall()
+        percorso = _percorso_nuovo(cartella, mese)
+        temporaneo = percorso + ".tmp"
+        with gzip.open(temporaneo, "wt", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(COLONNE)
+            writer.writerows(righe)
+        os.replace(temporaneo, percorso)
+
+        _aggiorna_coppie(conn, conn.execute(
+            "SELECT cane, volontario, COUNT(*) FROM storico WHERE data BETWEEN ? AND ? GROUP BY cane, volontario",
+            intervallo
+        ).fetchall(), +1)
+        conn.execute("INSERT OR REPLACE INTO archivio_mesi VALUES (?, ?, ?)",
+                     (mese, os.path.basename(percorso), len(righe)))
+        conn.execute("DELETE FROM storico WHERE data BETWEEN ? AND ?", intervallo)
+    return mesi
+
+
+def pulisci_archivi(percorso_db, cartella, attesa=ATTESA_PULIZIA):
+    """
+    Elimina i file di archivio non più registrati in `archivio_mesi` (sostituiti
+    da una nuova archiviazione o riaperti). Legge il registro già confermato con
+    una connessione propria, fuori dallo scrittore, e risparmia i file più
+    recenti di `attesa` secondi, che possono appartenere a una transazione in corso.
+    Returns:
+        list: i file eliminati
+    """
+    if not os.path.isdir(cartella):
+        return []
+    conn = sqlite3.connect(percorso_db)
+    try:
+        registrati = {file for (file,) in conn.execute("SELECT file FROM archivio_mesi")}
+    finally:
+        conn.close()
+    limite = time.time() - attesa
+    eliminati = []
+    for file in os.listdir(cartella):
+        percorso = os.path.join(cartella, file)
+        if (file.startswith("storico_") and file not in registrati
+                and os.path.getmtime(percorso) < limite):
+            os.remove(percorso)
+            eliminati.append(file)
+    return eliminati
+
+
+def riapri_mese(conn, cartella, mese):
+    """Riporta nella tabella storico un mese archiviato (prima di modificarlo)."""
+    riga = conn.execute("SELECT file FROM archivio_mesi WHERE mese=?", (mese,)).fetchone()
+    if riga is None:
+        return False
+    df = leggi_file(os.path.join(cartella, riga[0]))
+    conn.executemany("INSERT INTO storico VALUES (?, ?, ?, ?, ?)", df[COLONNE].itertuples(index=False))
+    _aggiorna_coppie(conn, df.groupby(["cane", "volontario"]).size().reset_index().itertuples(index=False), -1)
+    conn.execute("DELETE FROM archivio_mesi WHERE mese=?", (mese,))
+    return True
+
+
+def leggi_storico(conn, cartella, data_inizio, data_fine):
+    """
+    Storico tra due date ('AAAA-MM-GG', estremi inclusi): tabella calda più gli
+    archivi dei soli mesi che cadono nel periodo.
+    """
+    parti = [pd.read_sql_query(
+        "SELECT * FROM storico WHERE data BETWEEN ? AND ?", conn, params=(data_inizio, data_fine)
+    )]
+    for (file,) in conn.execute(
+        "SELECT file FROM archivio_mesi WHERE mese BETWEEN ? AND ? ORDER BY mese", (data_inizio[:7], data_fine[:7])
+    ):
+        df = leggi_file(os.path.join(cartella, file))
+        parti.append(df[(df["data"] >= data_inizio) & (df["data"] <= data_fine)])
+    if len(parti) == 1:
+        return parti[0]
+    return pd.concat(parti, ignore_index=True).sort_values(["data", "inizio"], ignore_index=True)
+
+
+def conteggi_coppie(conn):
+    """Quante volte ogni coppia cane/volontario è uscita insieme, archivi compresi."""
+    return {
+        (cane, vol): n for cane, vol, n in conn.execute('''
+            SELECT cane, volontario, SUM(n) FROM (
+                SELECT cane, volontario, COUNT(*) AS n FROM storico GROUP BY cane, volontario
+                UNION ALL
+                SELECT cane, volontario, conteggio FROM storico_coppie_archivio
+            ) GROUP BY cane, volontario''')
+    }
+
+
+def mesi_archiviati(conn):
+    """Elenco (mese, righe) dei mesi archiviati, dal più vecchio."""
+    return conn.execute("SELECT mese, righe FROM archivio_mesi ORDER BY mese").fetchall()
+
+
+# --- ULTIME USCITE ---
+
+def _imposta_uscite(conn, cane, date_uscita):
+    """Scrive le ultime due date (decrescenti) di un cane; nessuna data = riga eliminata."""
+    if not date_uscita:
+        conn.execute("DELETE FROM ultime_uscite WHERE cane=?", (cane,))
+    else:
+        conn.execute("INSERT OR REPLACE INTO ultime_uscite VALUES (?, ?, ?)",
+                     (cane, date_uscita[0], date_uscita[1] if len(date_uscita) > 1 else None))
+
+
+def ricostruisci_ultime_uscite(conn, cartella):
+    """
+    Popola `ultime_uscite` se è vuota (database creato prima della tabella):
+    tabella calda più archivi, dal mese più recente.
+    """
+    if conn.execute("SELECT 1 FROM ultime_uscite LIMIT 1").fetchone():
+        return
+    date_per_cane = {}
+    for cane, data in conn.execute("SELECT DISTINCT cane, data FROM storico ORDER BY data DESC"):
+        date_per_cane.setdefault(cane, []).append(data)
+    for (file,) in conn.execute("SELECT file FROM archivio_mesi ORDER BY mese DESC").fetchall():
+        df = leggi_file(os.path.join(cartella, file))
+        for cane, data in df[["cane", "data"]].drop_duplicates().sort_values("data", ascending=False).itertuples(index=False):
+            date_per_cane.setdefault(cane, []).append(data)
+    for cane, date_uscita in date_per_cane.items():
+        _imposta_uscite(conn, cane, date_uscita[:2])
+
+
+def registra_uscite(conn, data, cani_prima, cani_dopo):
+    """
+    Aggiorna `ultime_uscite` dopo aver sostituito lo storico del giorno `data`:
+    `cani_prima` e `cani_dopo` sono i cani presenti quel giorno prima e dopo.
+    """
+    for cane in set(cani_dopo) - set(cani_prima):
+        riga = conn.execute("SELECT ultima, precedente FROM ultime_uscite WHERE cane=?", (cane,)).fetchone()
+        date_uscita = sorted({data, *(d for d in (riga or ()) if d)}, reverse=True)
+        _imposta_uscite(conn, cane, date_uscita[:2])
+    for cane in set(cani_prima) - set(cani_dopo):
+        riga = conn.execute("SELECT ultima, precedente FROM ultime_uscite WHERE cane=?", (cane,)).fetchone()
+        if riga is None or data not in riga:
+            continue
+        # Il giorno tolto era tra le ultime due uscite: restano l'altra data nota e
+        # le più recenti della tabella calda (le uscite solo negli archivi non si recuperano)
+        rimaste = {d for d in riga if d and d != data}
+        rimaste.update(d for (d,) in conn.execute(
+            "SELECT DISTINCT data FROM storico WHERE cane=? ORDER BY data DESC LIMIT 2", (cane,)
+        ))
+        _imposta_uscite(conn, cane, sorted(rimaste, reverse=True)[:2])
+
+
+def uscite_prima(conn, cani, data):
+    """
+    Ultima uscita di ogni cane prima di `data` ('AAAA-MM-GG') secondo la tabella
+    calda; i cani senza uscite nella tabella non compaiono.
+    """
+    uscite = {}
+    for cane in cani:
+        (ultima,) = conn.execute("SELECT MAX(data) FROM storico WHERE cane=? AND data<?", (cane, data)).fetchone()
+        if ultima:
+            uscite[cane] = ultima
+    return uscite
+
+
+def ultime_uscite(conn):
+    """Dizionario cane -> (ultima, precedente) date di uscita ('AAAA-MM-GG', precedente può essere None)."""
+    return {cane: (ultima, precedente) for cane, ultima, precedente in conn.execute("SELECT * FROM ultime_uscite")}
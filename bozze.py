@@ -0,0 +1,237 @@
+"""
+Bozze del programma condivise tra coordinatori e scrittore unico del database.
+
+La bozza del programma di ogni giorno è salvata nel database con un numero di
+versione. Ogni modifica indica la versione da cui parte: se nel frattempo un
+altro coordinatore ha salvato, la modifica viene rifiutata con
+`ConflittoVersione` invece di sovrascrivere il suo lavoro. Ogni versione
+registra quali turni sono cambiati, così le altre sessioni possono aggiornare
+solo quelli.
+
+Tutte le scritture passano da un unico thread (`ScrittoreDB`) che le esegue in
+sequenza, raggruppando quelle arrivate insieme in un'unica transazione: niente
+contesa sui lock anche con molti salvataggi ravvicinati.
+"""
+import json
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+from pianificatore import Turno, chiave_turno
+
+# Quante versioni di modifiche tenere per giorno: chi è più indietro ricarica tutta la bozza
+MODIFICHE_CONSERVATE = 500
+
+
+class ConflittoVersione(Exception):
+    """La bozza è stata modificata da un'altra sessione dopo l'ultima lettura."""
+
+    def __init__(self, versione_attuale):
+        super().__init__(f"La bozza è alla versione {versione_attuale}")
+        self.versione_attuale = versione_attuale
+
+
+class ScrittoreDB:
+    """
+    Thread unico che esegue le scritture sul database.
+
+    `esegui(funzione, *args)` accoda `funzione(conn, *args)` e ne attende il
+    risultato. Le richieste accodate insieme vengono eseguite nella stessa
+    transazione, ciascuna nel proprio SAVEPOINT: un errore annulla solo la
+    richiesta che l'ha causato.
+    """
+
+    def __init__(self, percorso, max_lotto=64):
+        self.percorso = percorso
+        self.max_lotto = max_lotto
+        self._coda = queue.Queue()
+        self._thread = threading.Thread(target=self._ciclo, name=f"scrittore-{percorso}", daemon=True)
+        self._thread.start()
+
+    def esegui(self, funzione, *args, timeout=30):
+        futuro = Future()
+        self._coda.put((funzione, args, futuro))
+        return futuro.result(timeout=timeout)
+
+    def _ciclo(self):
+        conn = sqlite3.connect(self.percorso, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        while True:
+            lotto = [self._coda.get()]
+            while len(lotto) < self.max_lotto:
+                try:
+                    lotto.append(self._coda.get_nowait())
+                except queue.Empty:
+                    break
+            self._esegui_lotto(conn, lotto)
+
+    def _esegui_lotto(self, conn, lotto):
+        esiti = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for funzione, args, futuro in lotto:
+                conn.execute("SAVEPOINT richiesta")
+                try:
+                    esiti.append((futuro, funzione(conn, *args), None))
+                    conn.execute("RELEASE richiesta")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO richiesta")
+                    conn.execute("RELEASE richiesta")
+                    esiti.append((futuro, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, _, futuro in lotto:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+        # I risultati vengono consegnati solo dopo il COMMIT
+        for futuro, risultato, errore in esiti:
+            if errore is not None:
+                futuro.set_exception(errore)
+            else:
+                futuro.set_result(risultato)
+
+
+_scrittori = {}
+_lock_scrittori = threading.Lock()
+
+
+def scrittore(percorso):
+    """Restituisce lo scrittore unico (per processo) del database indicato."""
+    with _lock_scrittori:
+        if percorso not in _scrittori:
+            _scrittori[percorso] = ScrittoreDB(percorso)
+        return _scrittori[percorso]
+
+
+def init_schema(conn):
+    """Crea le tabelle delle bozze."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS bozze
+                    (data TEXT PRIMARY KEY, versione INTEGER NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS bozze_turni
+                    (data TEXT, id TEXT, orario TEXT, cane TEXT, volontari TEXT, luogo TEXT, tipo TEXT,
+                     versione INTEGER, PRIMARY KEY (data, id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS bozze_modifiche
+                    (data TEXT, versione INTEGER, id TEXT, operazione TEXT)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bozze_modifiche ON bozze_modifiche (data, versione)")
+
+
+def _turno_da_riga(riga):
+    id_turno, orario, cane, volontari, luogo, tipo = riga
+    return Turno(orario, cane, tuple(json.loads(volontari)), luogo, tipo, id=id_turno)
+
+
+def versione_bozza(conn, data):
+    """Versione corrente della bozza del giorno (0 se non esiste)."""
+    riga = conn.execute("SELECT versione FROM bozze WHERE data=?", (data,)).fetchone()
+    return riga[0] if riga else 0
+
+
+def carica_bozza(conn, data):
+    """
+    Carica la bozza completa del giorno.
+    Returns:
+        tuple: (versione, lista di Turno ordinata con `chiave_turno` (orario, id))
+    """
+    versione = versione_bozza(conn, data)
+    righe = conn.execute(
+        "SELECT id, orario, cane, volontari, luogo, tipo FROM bozze_turni WHERE data=?", (data,)
+    ).fetchall()
+    return versione, sorted((_turno_da_riga(r) for r in righe), key=chiave_turno)
+
+
+def modifiche_da(conn, data, versione):
+    """
+    Modifiche alla bozza successive a `versione`.
+    Returns:
+        tuple: (nuova versione, turni aggiunti o cambiati, id eliminati),
+        oppure None se il registro non copre più quell'intervallo (serve ricaricare tutto).
+    """
+    attuale = versione_bozza(conn, data)
+    if attuale == versione:
+        return attuale, [], set()
+    minima = conn.execute(
+        "SELECT MIN(versione) FROM bozze_modifiche WHERE data=?", (data,)
+    ).fetchone()[0]
+    if minima is None or minima > versione + 1:
+        return None
+    ultime = {}
+    for id_turno, operazione in conn.execute(
+        "SELECT id, operazione FROM bozze_modifiche WHERE data=? AND versione>? ORDER BY versione",
+        (data, versione)
+    ):
+        ultime[id_turno] = operazione
+    eliminati = {i for i, op in ultime.items() if op == "elimina"}
+    cambiati = [i for i, op in ultime.items() if op == "salva"]
+    turni = []
+    if cambiati:
+        segnaposti = ",".join("?" * len(cambiati))
+        turni = [_turno_da_riga(r) for r in conn.execute(
+            f"SELECT id, orario, cane, volontari, luogo, tipo FROM bozze_turni WHERE data=? AND id IN ({segnaposti})",
+            (data, *cambiati)
+        )]
+    return attuale, turni, eliminati
+
+
+def _applica_modifiche(conn, data, versione_attesa, salvati, eliminati):
+    """Richiesta eseguita dallo scrittore: verifica la versione e applica le modifiche."""
+    attuale = versione_bozza(conn, data)
+    if attuale != versione_attesa:
+        raise ConflittoVersione(attuale)
+    nuova = attuale + 1
+    conn.execute(
+        "INSERT INTO bozze (data, versione) VALUES (?, ?) ON CONFLICT(data) DO UPDATE SET versione=excluded.versione",
+        (data, nuova)
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO bozze_turni VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(data, t.id, t.orario, t.cane, json.dumps(list(t.volontari)), t.luogo, t.tipo, nuova) for t in salvati]
+    )
+    conn.executemany("DELETE FROM bozze_turni WHERE data=? AND id=?", [(data, i) for i in eliminati])
+    conn.executemany(
+        "INSERT INTO bozze_modifiche VALUES (?, ?, ?, ?)",
+        [(data, nuova, t.id, "salva") for t in salvati] + [(data, nuova, i, "elimina") for i in eliminati]
+    )
+    conn.execute(
+        "DELETE FROM bozze_modifiche WHERE data=? AND versione<=?", (data, nuova - MODIFICHE_CONSERVATE)
+    )
+    return nuova
+
+
+def differenze(vecchio, nuovo):
+    """
+    Confronta due versioni del programma.
+    Returns:
+        tuple: (turni nuovi o cambiati, id dei turni eliminati)
+    """
+    vecchi = {t.id: t for t in vecchio}
+    nuovi_id = {t.id for t in nuovo}
+    salvati = [t for t in nuovo if vecchi.get(t.id) != t]
+    eliminati = [i for i in vecchi if i not in nuovi_id]
+    return salvati, eliminati
+
+
+def salva_bozza(percorso, data, versione_attesa, vecchio, nuovo):
+    """
+    Salva il passaggio da `vecchio` a `nuovo` nella bozza del giorno.
+    Solleva `ConflittoVersione` se la bozza non è più alla `versione_attesa`.
+    Returns:
+        int: la nuova versione della bozza
+    """
+    salvati, eliminati = differenze(vecchio, nuovo)
+    if not salvati and not eliminati:
+        return versione_attesa
+    return scrittore(percorso).esegui(_applica_modifiche, data, versione_attesa, salvati, eliminati)
+
+
+def applica_a_programma(programma, turni, eliminati):
+    """Applica a una copia del programma le modifiche ricevute da un'altra sessione."""
+    aggiornati = {t.id for t in turni}
+    risultato = [t for t in programma if t.id not in eliminati and t.id not in aggiornati]
+    risultato.extend(turni)
+    risultato.sort(key=chiave_turno)
+    return risultato
@@ -0,0 +1,192 @@
+"""
+Pacchetti di briefing per i volontari.
+
+Per ogni volontario viene prodotto un PDF con la sua scaletta del turno e le
+schede dei cani che porterà (CIBO, GUINZAGLIERIA, STRUMENTI, ...), più un
+foglio Excel per volontario in un unico file. Tutto viene consegnato in un
+solo ZIP. I PDF sono generati in parallelo da un pool di processi; il modulo
+non dipende da Streamlit.
+"""
+import io
+import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from xml.sax.saxutils import escape
+
+from pianificatore import contesto_processi
+
+CAMPI_PROFILO = ["CIBO", "GUINZAGLIERIA", "STRUMENTI", "ATTIVITÀ", "NOTE", "TEMPO"]
+COLONNE_SCALETTA = ["Orario", "Cane", "Luogo", "Tipo", "Con"]
+
+
+def turni_per_volontario(programma, schede_cani):
+    """
+    Raggruppa i turni del programma per volontario.
+
+    `programma` è la lista di Turno; `schede_cani` è un dizionario
+    {cane: {campo: testo}} con i campi di CAMPI_PROFILO, unito ai turni per nome
+    del cane. I turni collettivi compaiono nella scaletta di tutti.
+
+    Returns:
+        tuple: (scalette {volontario: [righe]}, profili {cane: {campo: testo}})
+    """
+    volontari = sorted({v for t in programma if not t.collettivo for v in t.volontari})
+    scalette = {v: [] for v in volontari}
+    profili = {}
+    for t in programma:
+        if not t.collettivo:
+            scheda = schede_cani.get(t.cane, {})
+            profili.setdefault(t.cane, {campo: str(scheda.get(campo, "") or "") for campo in CAMPI_PROFILO})
+        for v in volontari if t.collettivo else t.volontari:
+            scalette[v].append({
+                "Orario": t.orario,
+                "Cane": t.cane,
+                "Luogo": t.luogo,
+                "Tipo": t.tipo,
+                "Con": "" if t.collettivo else ", ".join(x for x in t.volontari if x != v),
+            })
+    return scalette, profili
+
+
+def _blocco_profilo(cane, profilo):
+    """Markup reportlab della scheda di un cane (titolo e paragrafi)."""
+    paragrafi = [escape(cane)]
+    for campo in CAMPI_PROFILO:
+        valore = profilo.get(campo, "")
+        if valore.strip():
+            testo = escape(valore.strip()).replace("\n", "<br/>")
+            paragrafi.append(f"<b>{campo}:</b> {testo}")
+    return tuple(paragrafi)
+
+
+def _pdf_volontario(parametri):
+    """Genera il PDF di un volontario (eseguito nei processi del pool)."""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import cm
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    volontario, data_turno, scaletta, schede = parametri
+    stili = getSampleStyleSheet()
+    # Il nome del cane resta sulla stessa pagina della sua scheda (senza KeepTogether,
+    # che impagina il blocco due volte)
+    stile_nome = ParagraphStyle("NomeCane", parent=stili["Heading4"], keepWithNext=True)
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=1.5 * cm, rightMargin=1.5 * cm,
+                            topMargin=1.5 * cm, bottomMargin=1.5 * cm, title=f"Briefing {volontario}")
+
+    elementi = [
+        Paragraph(f"Programma del {escape(data_turno)}", stili["Title"]),
+        Paragraph(f"Volontario: <b>{escape(volontario)}</b>", stili["Heading2"]),
+        Spacer(1, 0.3 * cm),
+    ]
+
+    tabella = Table(
+        [COLONNE_SCALETTA] + [[r[c] for c in COLONNE_SCALETTA] for r in scaletta],
+        repeatRows=1, colWidths=[2 * cm, 4 * cm, 4 * cm, 3 * cm, 5 * cm],
+    )
+    tabella.setStyle(TableStyle([
+        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+        ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ]))
+    elementi += [tabella, Spacer(1, 0.6 * cm)]
+
+    cani = [r["Cane"] for r in scaletta if r["Cane"] in schede]
+    if cani:
+        elementi.append(Paragraph("Schede dei cani", stili["Heading2"]))
+    for cane in dict.fromkeys(cani):
+        titolo, *righe = schede[cane]
+        elementi.append(Paragraph(titolo, stile_nome))
+        elementi += [Paragraph(p, stili["Normal"]) for p in righe]
+        elementi.append(Spacer(1, 0.4 * cm))
+
+    doc.build(elementi)
+    return volontario, buffer.getvalue()
+
+
+def nome_file(testo):
+    """Rende un nome utilizzabile come nome di file."""
+    return re.sub(r"[^\w\-]+", "_", testo).strip("_") or "volontario"
+
+
+def _nome_file_unico(testo, usati):
+    """`nome_file` non duplicato (senza distinzione maiuscole/minuscole): 'Anna M.' e 'Anna M' non si sovrascrivono."""
+    base = nome_file(testo)
+    nome, n = base, 1
+    while nome.lower() in usati:
+        n += 1
+        nome = f"{base}_{n}"
+    usati.add(nome.lower())
+    return nome
+
+
+def _nome_foglio(testo, usati):
+    """Nome di foglio Excel valido (max 31 caratteri, senza []:*?/\\) e non duplicato."""
+    base = re.sub(r"[\[\]:*?/\\]", "_", testo)[:31] or "Volontario"
+    nome, n = base, 1
+    while nome.lower() in usati:
+        n += 1
+        suffisso = f" ({n})"
+        nome = base[:31 - len(suffisso)] + suffisso
+    usati.add(nome.lower())
+    return nome
+
+
+def _excel_scalette(scalette, profili):
+    """Un unico file Excel con un foglio per volontario (scaletta + schede dei cani)."""
+    import pandas as pd
+
+    buffer = io.BytesIO()
+    usati = set()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        for volontario, scaletta in scalette.items():
+            df = pd.DataFrame(scaletta, columns=COLONNE_SCALETTA)
+            for campo in CAMPI_PROFILO:
+                df[campo] = [profili.get(cane, {}).get(campo, "") for cane in df["Cane"]]
+            df.to_excel(writer, sheet_name=_nome_foglio(volontario, usati), index=False)
+    return buffer.getvalue()
+
+
+def genera_pacchetto_briefing(scalette, profili, data_turno, processi=None):
+    """
+    Crea lo ZIP con un PDF per volontario e il file Excel con un foglio per volontario.
+
+    I PDF vengono generati in parallelo e aggiunti allo ZIP man mano che sono
+    pronti, mentre il processo principale scrive il file Excel.
+
+    Returns:
+        bytes: contenuto del file ZIP
+    """
+    processi = processi or os.cpu_count() or 1
+    suffisso = data_turno.replace("-", "")
+    # Le schede vengono preparate una volta qui: un cane condiviso da più volontari
+    # non viene riformattato in ogni processo
+    schede = {cane: _blocco_profilo(cane, profilo) for cane, profilo in profili.items()}
+    lavori = [
+        (v, data_turno, scaletta, {r["Cane"]: schede[r["Cane"]] for r in scaletta if r["Cane"] in schede})
+        for v, scaletta in scalette.items()
+    ]
+
+    usati = set()
+    nomi_pdf = {v: f"pdf/{_nome_file_unico(v, usati)}_{suffisso}.pdf" for v in scalette}
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        if processi > 1 and len(lavori) > 1:
+            with ProcessPoolExecutor(max_workers=min(processi, len(lavori)), mp_context=contesto_processi()) as pool:
+                futuri = [pool.submit(_pdf_volontario, lavoro) for lavoro in lavori]
+                zf.writestr(f"programma_volontari_{suffisso}.xlsx", _excel_scalette(scalette, profili))
+                for futuro in as_completed(futuri):
+                    volontario, pdf = futuro.result()
+                    zf.writestr(nomi_pdf[volontario], pdf)
+        else:
+            zf.writestr(f"programma_volontari_{suffisso}.xlsx", _excel_scalette(scalette, profili))
+            for lavoro in lavori:
+                volontario, pdf = _pdf_volontario(lavoro)
+                zf.writestr(nomi_pdf[volontario], pdf)
+    return buffer.getvalue()
@@ -0,0 +1,284 @@
+"""
+Esportazione di storico e anagrafica per altri sistemi (report dell'associazione).
+
+Le righe vengono lette e scritte a blocchi, con una paginazione a cursore: la
+memoria usata non dipende dalla dimensione dell'esportazione e un'esportazione
+interrotta può ripartire dall'ultimo cursore.
+
+Ogni scrittura dell'app registra in `revisioni` la revisione della chiave
+modificata: il giorno per lo storico (un salvataggio sostituisce tutte le
+righe del giorno), il nome del cane per l'anagrafica. Il cursore è la coppia
+"revisione:chiave" dell'ultimo elemento esportato, quindi un'esportazione
+incrementale trasferisce solo i giorni e i cani cambiati da allora.
+
+Nello storico ogni giorno esportato sostituisce per intero lo stesso giorno
+già importato; un giorno svuotato compare come una riga con i soli campi
+`data` e `rev`. I giorni dei mesi archiviati vengono letti dagli archivi.
+
+Uso:
+    python esporta.py storico --formato csv --output storico.csv
+    python esporta.py storico --incrementale --nome report > nuovi.jsonl
+    python esporta.py anagrafica --cursore 12:Fido
+    python esporta.py --servi 8502
+        GET /storico?cursore=0:&limite=1000  ->  {"righe": [...], "cursore": "...", "altre": true}
+"""
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import archivio
+
+DB_PATH = os.environ.get("CANILE_DB", "canile.db")
+COLONNE = {
+    "storico": ["data", "inizio", "cane", "volontario", "luogo", "rev"],
+    "anagrafica": ["nome", "cibo", "guinzaglieria", "strumenti", "attivita", "note", "tempo", "rev"],
+}
+CURSORE_INIZIALE = "0:"
+CHIAVI_PER_PAGINA = 200
+RIGHE_PER_BLOCCO = 1000
+
+
+def init_schema(conn):
+    """Crea le tabelle delle revisioni e dei cursori delle esportazioni incrementali."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS revisioni
+                    (tabella TEXT, chiave TEXT, rev INTEGER NOT NULL, PRIMARY KEY (tabella, chiave))''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_revisioni_rev ON revisioni (tabella, rev, chiave)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS cursori_export
+                    (nome TEXT, tabella TEXT, cursore TEXT NOT NULL, PRIMARY KEY (nome, tabella))''')
+
+
+def segna_revisione(conn, tabella, chiavi, rev):
+    """Registra che le chiavi indicate sono cambiate alla revisione `rev` (nella transazione della scrittura)."""
+    conn.executemany("INSERT OR REPLACE INTO revisioni VALUES (?, ?, ?)", [(tabella, k, rev) for k in chiavi])
+
+
+def ricostruisci_revisioni(conn, cartella_archivio):
+    """
+    Registra a revisione 0 i giorni e i cani già presenti quando la tabella
+    delle revisioni non esisteva ancora (una volta sola per tabella).
+    """
+    if not conn.execute("SELECT 1 FROM revisioni WHERE tabella='storico' LIMIT 1").fetchone():
+        giorni = {d for (d,) in conn.execute("SELECT DISTINCT data FROM storico")}
+        for (file,) in conn.execute("SELECT file FROM archivio_mesi").fetchall():
+            giorni.update(archivio.leggi_file(os.path.join(cartella_archivio, file))["data"].unique())
+        segna_revisione(conn, "storico", sorted(giorni), 0)
+    if not conn.execute("SELECT 1 FROM revisioni WHERE tabella='anagrafica' LIMIT 1").fetchone():
+        segna_revisione(conn, "anagrafica", [n for (n,) in conn.execute("SELECT nome FROM anagrafica_cani")], 0)
+
+
+def leggi_cursore(testo):
+    """'revisione:chiave' -> (revisione, chiave)."""
+    rev, _, chiave = (testo or CURSORE_INIZIALE).partition(":")
+    return int(rev), chiave
+
+
+def scrivi_cursore(rev, chiave):
+    return f"{rev}:{chiave}"
+
+
+def _pagine_chiavi(conn, tabella, cursore):
+    """Chiavi cambiate dopo il cursore, in ordine (rev, chiave), a pagine di CHIAVI_PER_PAGINA."""
+    rev, chiave = leggi_cursore(cursore)
+    while True:
+        pagina = conn.execute(
+            '''SELECT chiave, rev FROM revisioni WHERE tabella=? AND (rev, chiave) > (?, ?)
+               ORDER BY rev, chiave LIMIT ?''',
+            (tabella, rev, chiave, CHIAVI_PER_PAGINA)
+        ).fetchall()
+        if not pagina:
+            return
+        yield pagina
+        chiave, rev = pagina[-1]
+
+
+def _righe_storico(conn, cartella_archivio, giorni, mesi_archiviati, mese_in_memoria):
+    """Righe dei giorni indicati: dalla tabella calda o, per i mesi archiviati, dal file del mese."""
+    caldi = [g for g, _ in giorni if g[:7] not in mesi_archiviati]
+    per_giorno = {}
+    if caldi:
+        segnaposti = ",".join("?" * len(caldi))
+        for riga in conn.execute(
+            f"SELECT data, inizio, cane, volontario, luogo FROM storico WHERE data IN ({segnaposti}) "
+            "ORDER BY data, inizio, cane, volontario", caldi
+        ):
+            per_giorno.setdefault(riga[0], []).append(riga)
+    for giorno, rev in giorni:
+        mese = giorno[:7]
+        if mese in mesi_archiviati:
+            # Si tiene in memoria un solo mese: le chiavi arrivano per lo più in ordine di data
+            if mese_in_memoria.get("mese") != mese:
+                df = archivio.leggi_file(os.path.join(cartella_archivio, mesi_archiviati[mese]))
+                per_data = {}
+                for r in df[archivio.COLONNE].itertuples(index=False, name=None):
+                    per_data.setdefault(r[0], []).append(r)
+                mese_in_memoria.update(mese=mese, righe=per_data)
+            righe = mese_in_memoria["righe"].get(giorno, [])
+        else:
+            righe = per_giorno.get(giorno, [])
+        if righe:
+            for r in righe:
+                yield giorno, rev, dict(zip(COLONNE["storico"], (*r, rev)))
+        else:
+            yield giorno, rev, {"data": giorno, "rev": rev}
+
+
+def _righe_anagrafica(conn, nomi):
+    segnaposti = ",".join("?" * len(nomi))
+    trovati = {r[0]: r for r in conn.execute(
+        f"SELECT nome, cibo, guinzaglieria, strumenti, attivita, note, tempo FROM anagrafica_cani "
+        f"WHERE nome IN ({segnaposti})", [n for n, _ in nomi]
+    )}
+    for nome, rev in nomi:
+        if nome in trovati:
+            yield nome, rev, dict(zip(COLONNE["anagrafica"], (*trovati[nome], rev)))
+
+
+def blocchi(conn, tabella, cursore=CURSORE_INIZIALE, righe_per_blocco=RIGHE_PER_BLOCCO, cartella_archivio=None):
+    """
+    Genera (righe, cursore) a blocchi di circa `righe_per_blocco` righe. Il cursore
+    restituito con un blocco permette di riprendere subito dopo di esso; un blocco
+    non spezza mai un giorno dello storico.
+    """
+    if cartella_archivio is None:
+        cartella_archivio = archivio.cartella_archivio(DB_PATH)
+    mesi_archiviati = dict(conn.execute("SELECT mese, file FROM archivio_mesi").fetchall())
+    mese_in_memoria = {}
+    blocco, ultima = [], None
+    for pagina in _pagine_chiavi(conn, tabella, cursore):
+        if tabella == "storico":
+            righe = _righe_storico(conn, cartella_archivio, pagina, mesi_archiviati, mese_in_memoria)
+        else:
+            righe = _righe_anagrafica(conn, pagina)
+        for chiave, rev, riga in righe:
+            if len(blocco) >= righe_per_blocco and (chiave, rev) != ultima:
+                yield blocco, scrivi_cursore(ultima[1], ultima[0])
+                blocco = []
+            blocco.append(riga)
+            ultima = (chiave, rev)
+    if blocco:
+        yield blocco, scrivi_cursore(ultima[1], ultima[0])
+
+
+def ci_sono_altre(conn, tabella, cursore):
+    """True se esistono modifiche successive al cursore."""
+    rev, chiave = leggi_cursore(cursore)
+    return conn.execute(
+        "SELECT 1 FROM revisioni WHERE tabella=? AND (rev, chiave) > (?, ?) LIMIT 1", (tabella, rev, chiave)
+    ).fetchone() is not None
+
+
+# --- USCITA ---
+
+def scrivi_righe(blocchi_righe, formato, uscita, tabella):
+    """Scrive i blocchi man mano che arrivano; restituisce (righe scritte, ultimo cursore)."""
+    totale, cursore = 0, None
+    writer = None
+    if formato == "csv":
+        writer = csv.DictWriter(uscita, fieldnames=COLONNE[tabella], restval="")
+        writer.writeheader()
+    for righe, cursore in blocchi_righe:
+        if writer:
+            writer.writerows(righe)
+        else:
+            uscita.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in righe)
+        uscita.flush()
+        totale += len(righe)
+    return totale, cursore
+
+
+def servi(porta, percorso_db):
+    """Endpoint HTTP di sola lettura: GET /storico o /anagrafica con ?cursore=&limite=."""
+
+    class Gestore(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            tabella = url.path.strip("/")
+            parametri = parse_qs(url.query)
+            if tabella not in COLONNE:
+                self.send_error(404, "Usa /storico o /anagrafica")
+                return
+            try:
+                cursore = parametri.get("cursore", [CURSORE_INIZIALE])[0]
+                leggi_cursore(cursore)
+                limite = min(int(parametri.get("limite", [RIGHE_PER_BLOCCO])[0]), 10 * RIGHE_PER_BLOCCO)
+                if limite < 1:
+                    raise ValueError(limite)
+            except ValueError:
+                self.send_error(400, "Cursore o limite non validi")
+                return
+            conn = sqlite3.connect(percorso_db)
+            try:
+                generatore = blocchi(conn, tabella, cursore, limite, archivio.cartella_archivio(percorso_db))
+                righe, successivo = next(generatore, ([], cursore))
+                altre = ci_sono_altre(conn, tabella, successivo)
+            finally:
+                conn.close()
+            corpo = json.dumps({"righe": righe, "cursore": successivo, "altre": altre}, ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+    server = ThreadingHTTPServer(("127.0.0.1", porta), Gestore)
+    print(f"Esportazione disponibile su http://127.0.0.1:{porta}/storico e /anagrafica", file=sys.stderr)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Esporta storico e anagrafica a blocchi (JSON Lines o CSV)")
+    parser.add_argument("tabella", nargs="?", choices=sorted(COLONNE))
+    parser.add_argument("--formato", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--output", help="File di uscita (default: standard output)")
+    parser.add_argument("--cursore", default=CURSORE_INIZIALE, help="Riparte dopo questo cursore")
+    parser.add_argument("--incrementale", action="store_true",
+                        help="Esporta solo le modifiche dall'ultima esportazione con lo stesso --nome")
+    parser.add_argument("--nome", default="predefinito", help="Nome del destinatario per --incrementale")
+    parser.add_argument("--blocco", type=int, default=RIGHE_PER_BLOCCO, help="Righe per blocco")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--servi", type=int, metavar="PORTA", help="Avvia l'endpoint HTTP invece di esportare")
+    args = parser.parse_args()
+
+    if args.servi:
+        servi(args.servi, args.db)
+        return
+    if not args.tabella:
+        parser.error("indica la tabella da esportare (storico o anagrafica)")
+    if args.blocco < 1:
+        parser.error("--blocco deve essere almeno 1")
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA busy_timeout=10000")
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='revisioni'").fetchone():
+        sys.exit("Il database non ha ancora la tabella delle revisioni: avvia l'app una volta")
+    cursore = args.cursore
+    if args.incrementale:
+        riga = conn.execute("SELECT cursore FROM cursori_export WHERE nome=? AND tabella=?",
+                            (args.nome, args.tabella)).fetchone()
+        cursore = riga[0] if riga else CURSORE_INIZIALE
+
+    uscita = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        totale, ultimo = scrivi_righe(
+            blocchi(conn, args.tabella, cursore, args.blocco, archivio.cartella_archivio(args.db)),
+            args.formato, uscita, args.tabella
+        )
+    finally:
+        if args.output:
+            uscita.close()
+
+    # Il cursore si aggiorna solo a esportazione completata
+    if args.incrementale and ultimo:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO cursori_export VALUES (?, ?, ?)", (args.nome, args.tabella, ultimo))
+    conn.close()
+    print(f"{totale} righe esportate, cursore: {ultimo or cursore}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Misura i tempi di avvio a freddo dell'app.
+
+Ogni ripetizione gira in un processo Python nuovo, così gli import non sono
+già in cache. Per ciascuna vengono misurati:
+- import_streamlit: tempo di import di Streamlit (a carico del server);
+- import, primo_render, dati: tempi registrati dall'app stessa alla prima
+  esecuzione (vedi `registra_misura` in app.py);
+- totale: durata della prima esecuzione completa dello script.
+
+Uso:
+    python misura_avvio.py --ripetizioni 5 --csv misure_avvio.csv
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+CAMPI = ["import_streamlit", "import", "primo_render", "dati", "totale"]
+
+
+def misura_singola():
+    """Esegue una misura nel processo corrente (che deve essere appena avviato)."""
+    t0 = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    import_streamlit = time.perf_counter() - t0
+
+    at = AppTest.from_file(APP, default_timeout=120)
+    t0 = time.perf_counter()
+    at.run()
+    totale = time.perf_counter() - t0
+
+    misure = dict(at.session_state.misure_avvio) if "misure_avvio" in at.session_state else {}
+    misure["import_streamlit"] = round(import_streamlit, 3)
+    misure["totale"] = round(totale, 3)
+    misure["errori"] = len(at.exception)
+    return misure
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Misura i tempi di avvio a freddo dell'app")
+    parser.add_argument("--ripetizioni", type=int, default=3)
+    parser.add_argument("--csv", help="File CSV a cui accodare le misure")
+    parser.add_argument("--figlio", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.figlio:
+        print(json.dumps(misura_singola()))
+        return
+
+    risultati = []
+    for _ in range(args.ripetizioni):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--figlio"],
+            capture_output=True, text=True, check=True,
+        )
+        risultati.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    print(f"{'misura':<18}{'mediana (s)':>12}{'max (s)':>10}")
+    for campo in CAMPI:
+        valori = [r[campo] for r in risultati if campo in r]
+        if valori:
+            print(f"{campo:<18}{statistics.median(valori):>12.3f}{max(valori):>10.3f}")
+    errori = sum(r.get("errori", 0) for r in risultati)
+    if errori:
+        print(f"⚠️ {errori} eccezioni durante le esecuzioni")
+
+    if args.csv:
+        nuovo = not os.path.exists(args.csv)
+        with open(args.csv, "a", newline="") as f:
+            writer = csv.writer(f)
+            if nuovo:
+                writer.writerow(["timestamp", "host"] + CAMPI)
+            for r in risultati:
+                writer.writerow(
+                    [datetime.now().isoformat(timespec="seconds"), platform.node()]
+                    + [r.get(campo, "") for campo in CAMPI]
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+"""
+Logica di pianificazione dei turni, indipendente da Streamlit.
+
+Le funzioni di questo modulo non leggono il database né `st.session_state`:
+ricevono tutto ciò che serve tramite un dizionario `contesto` preparato una
+volta sola dall'app. Questo le rende veloci e utilizzabili anche nei processi
+della simulazione Monte Carlo.
+"""
+import multiprocessing
+import os
+import random
+from collections import Counter, deque
+from bisect import insort
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import date, timedelta
+from enum import IntEnum
+from itertools import chain
+from time import perf_counter
+from uuid import uuid4
+
+CANI_SPECIALI = ["TUTTI", "Da assegnare"]
+TRACCIA_MAX_EVENTI = 5000
+
+
+class Livello(IntEnum):
+    """Livello di colore di cani e volontari: un volontario gestisce i cani fino al suo livello."""
+    VERDE = 1
+    ARANCIONE = 2
+    ROSSO = 3
+    NERO = 4
+
+
+LIVELLI = {livello.name.lower(): livello for livello in Livello}
+# Un cane che non risulta nel foglio (o senza colore valido) è trattato come il più difficile
+LIVELLO_CANE_SCONOSCIUTO = Livello.NERO
+COLORE_CANE_SCONOSCIUTO = LIVELLO_CANE_SCONOSCIUTO.name.lower()
+
+
+def get_livello_colore(colore):
+    """
+    Restituisce il livello numerico del colore.
+    Scala: nero (4) > rosso (3) > arancione (2) > verde (1)
+    """
+    return LIVELLI.get(colore.lower().strip(), Livello.VERDE)  # default verde se non riconosciuto
+
+
+def messaggio_compatibilita(compatibile, colore_cane):
+    """Messaggio mostrato per un abbinamento cane/volontario."""
+    if compatibile:
+        return "✅ OK"
+    return f"⚠️ INCOMPATIBILE: serve volontario {colore_cane} o superiore"
+
+
+def verifica_compatibilita_colore(colore_volontario, colore_cane):
+    """
+    Verifica se un volontario può gestire un cane in base ai colori.
+    Regola: Il volontario può gestire cani del suo stesso livello o inferiore.
+
+    Scala volontari (dal più esperto al principiante):
+    - Nero (4): può gestire tutti (nero, rosso, arancione, verde)
+    - Rosso (3): può gestire rosso, arancione, verde
+    - Arancione (2): può gestire arancione, verde
+    - Verde (1): può gestire solo verde
+
+    Returns:
+        tuple: (bool compatibile, str messaggio)
+    """
+    compatibile = get_livello_colore(colore_volontario) >= get_livello_colore(colore_cane)
+    return compatibile, messaggio_compatibilita(compatibile, colore_cane)
+
+
+def turno_in_conflitto(cane, campo, turni_attuali, ora_attuale_str, contesto):
+    """
+    Il primo turno alla stessa ora in un campo adiacente che, per reattività,
+    impedisce di usare `campo` per il cane; None se il campo va bene.
+    """
+    reattivita = contesto["reattivita"]
+    reattivita_cane_corrente = reattivita.get(cane, 0)
+    campi_adiacenti = contesto["adiacenze"].get(campo, [])
+    if not campi_adiacenti:
+        return None
+    for turno in turni_attuali:
+        if turno.orario == ora_attuale_str:
+            if turno.luogo in campi_adiacenti:
+                cane_adiacente = turno.cane
+                if cane_adiacente in CANI_SPECIALI:
+                    continue
+                reattivita_cane_adiacente = reattivita.get(cane_adiacente, 0)
+                if reattivita_cane_corrente > 5 or reattivita_cane_adiacente > 5:
+                    return turno
+    return None
+
+
+def campo_valido_per_reattivita(cane, campo, turni_attuali, ora_attuale_str, contesto):
+    """Verifica se un campo è valido per un cane considerando la reattività dei cani adiacenti."""
+    return turno_in_conflitto(cane, campo, turni_attuali, ora_attuale_str, contesto) is None
+
+
+def trova_volontario_compatibile(cane, volontari_liberi, contesto, punteggi=None):
+    """
+    Trova il miglior volontario compatibile per un cane: prima i compatibili,
+    poi chi è già uscito più volte con il cane, poi il livello più alto
+    (a parità, l'ordine di `volontari_liberi`).
+    Se `punteggi` è una lista, vi aggiunge tutti i candidati in ordine di
+    preferenza con il loro punteggio (per la traccia dello scheduler).
+    Restituisce: (volontario, colore_vol, compatibile, messaggio)
+    """
+    livello_cane = contesto["livelli_cani"].get(cane, LIVELLO_CANE_SCONOSCIUTO)
+    livelli_volontari = contesto["livelli_volontari"]
+    storico_coppie = contesto["storico_coppie"]
+
+    def punteggio(vol):
+        livello_vol = livelli_volontari.get(vol, Livello.VERDE)
+        return (livello_vol < livello_cane, -storico_coppie.get((cane, vol), 0), -livello_vol)
+
+    migliore = min(volontari_liberi, key=punteggio, default=None)
+    if punteggi is not None:
+        for vol in sorted(volontari_liberi, key=punteggio):
+            incompatibile, uscite, livello = punteggio(vol)
+            punteggi.append({"volontario": vol, "compatibile": not incompatibile,
+                             "uscite_insieme": -uscite, "livello": Livello(-livello).name})
+    if migliore is None:
+        return None, None, False, "Nessun volontario disponibile"
+
+    compatibile = livelli_volontari.get(migliore, Livello.VERDE) >= livello_cane
+    colore_cane = contesto["colori_cani"].get(cane, COLORE_CANE_SCONOSCIUTO)
+    return (migliore, contesto["colori_volontari"].get(migliore, 'verde'), compatibile,
+            messaggio_compatibilita(compatibile, colore_cane))
+
+
+def giorni_senza_uscite(cane, giorno, contesto):
+    """
+    Giorni trascorsi dall'ultima uscita del cane prima di `giorno` (una data),
+    oppure None se non risulta mai uscito. Usa il riepilogo `ultime_uscite`
+    (ultime due date per cane), così un giorno già salvato non conta per sé stesso.
+    Se le date note sono tutte da `giorno` in poi (giorni successivi già salvati)
+    il cane conta come uscito di recente (0 giorni), non come mai uscito.
+    """
+    giorno_str = giorno.isoformat()
+    date_note = [data for data in contesto["ultime_uscite"].get(cane, ()) if data]
+    for data in date_note:
+        if data < giorno_str:
+            return (giorno - date.fromisoformat(data)).days
+    return 0 if date_note else None
+
+
+def priorita_cane(cane, giorno, contesto):
+    """
+    Chiave di priorità di un cane (più piccola = prima): prima chi non esce da
+    più giorni (o non è mai uscito), poi i cani di livello più alto, che hanno
+    meno volontari compatibili, poi i più reattivi, più difficili da sistemare.
+    """
+    giorni = giorni_senza_uscite(cane, giorno, contesto)
+    return (
+        -(giorni if giorni is not None else float("inf")),
+        -contesto["livelli_cani"].get(cane, LIVELLO_CANE_SCONOSCIUTO),
+        -contesto["reattivita"].get(cane, 0),
+    )
+
+
+def ordina_per_priorita(cani, giorno, contesto):
+    """Cani in ordine di priorità; a parità resta l'ordine di selezione."""
+    return sorted(cani, key=lambda cane: priorita_cane(cane, giorno, contesto))
+
+
+@dataclass(frozen=True, slots=True)
+class Turno:
+    """
+    Una riga del programma. Cane, volontari e luogo sono riferiti per nome;
+    colori e anagrafica vengono uniti solo quando il programma viene mostrato
+    o esportato. `id` identifica il turno nella bozza condivisa.
+    """
+    orario: str
+    cane: str
+    volontari: tuple
+    luogo: str
+    tipo: str
+    id: str = field(default_factory=lambda: uuid4().hex[:12])
+
+    @property
+    def volontario(self):
+        """Volontari come testo, es. 'Anna, Marco'."""
+        return ", ".join(self.volontari)
+
+    @property
+    def collettivo(self):
+        """True per i turni che riguardano tutti (briefing, pasti)."""
+        return self.cane in CANI_SPECIALI
+
+
+def chiave_turno(turno):
+    """
+    Chiave di ordinamento del programma: orario, poi id. L'ordine è totale, così
+    ogni sessione che tiene la stessa bozza ha i turni nello stesso ordine.
+    """
+    return turno.orario, turno.id
+
+
+def inserisci_turno(programma, turno):
+    """Inserisce un turno mantenendo il programma ordinato (vedi `chiave_turno`)."""
+    insort(programma, turno, key=chiave_turno)
+
+
+def turno_collettivo(orario, luogo, tipo):
+    """Crea una riga di programma valida per tutti (briefing, pasti)."""
+    return Turno(orario, "TUTTI", ("TUTTI",), luogo, tipo)
+
+
+def turno_compatibile(turno, contesto):
+    """
+    Verifica la compatibilità colori di un turno: tutti i volontari devono poter
+    gestire il cane. Restituisce None per i turni collettivi.
+    """
+    if turno.collettivo:
+        return None
+    livello_cane = contesto["livelli_cani"].get(turno.cane, LIVELLO_CANE_SCONOSCIUTO)
+    livelli_volontari = contesto["livelli_volontari"]
+    return all(livelli_volontari.get(v, Livello.VERDE) >= livello_cane for v in turno.volontari)
+
+
+def nuova_traccia(max_eventi=TRACCIA_MAX_EVENTI):
+    """Buffer circolare per la traccia di `genera_programma`: tiene solo gli ultimi `max_eventi` eventi."""
+    return deque(maxlen=max_eventi)
+
+
+def _descrivi_priorita(cani, giorno, contesto, massimo=30):
+    parti = []
+    for cane in cani[:massimo]:
+        giorni = giorni_senza_uscite(cane, giorno, contesto)
+        parti.append(f"{cane} ({'mai uscito' if giorni is None else f'{giorni} gg'})")
+    return ", ".join(parti) + (f" … (+{len(cani) - massimo})" if len(cani) > massimo else "")
+
+
+def genera_programma(cani, volontari, luoghi, start_dt, end_dt, manuali, contesto, traccia=None):
+    """
+    Genera il programma automatico del turno.
+
+    `luoghi` sono i luoghi già filtrati per l'assegnazione automatica, `manuali`
+    i turni inseriti a mano (ordinati con `chiave_turno`) che vengono mantenuti.
+    Non ha effetti collaterali.
+
+    Se `traccia` non è None (es. `nuova_traccia()`), vi aggiunge un dizionario
+    per ogni decisione: ordine di priorità, luoghi rifiutati per reattività,
+    candidati e punteggi di ogni assegnazione, cani esclusi e durata di ogni
+    fascia oraria. Senza traccia il costo è un solo confronto per decisione.
+
+    Returns:
+        tuple: (programma ordinato con `chiave_turno`, abbinamenti_non_compatibili)
+    """
+    pasti_dt = end_dt - timedelta(minutes=30)
+    non_compatibili = []
+
+    # Briefing iniziale
+    programma = [turno_collettivo(start_dt.strftime('%H:%M'), "Ufficio", "Briefing")]
+
+    # I posti sono pochi: li ottengono per primi i cani che ne hanno più bisogno
+    cani_fatti = {m.cane for m in manuali}
+    cani_restanti = ordina_per_priorita([c for c in cani if c not in cani_fatti], start_dt.date(), contesto)
+    if traccia is not None:
+        traccia.append({"evento": "priorità", "dettaglio": _descrivi_priorita(cani_restanti, start_dt.date(), contesto)})
+    curr_t = start_dt + timedelta(minutes=15)
+
+    while cani_restanti and curr_t < pasti_dt:
+        ora_s = curr_t.strftime('%H:%M')
+        if traccia is not None:
+            inizio_fascia, assegnati = perf_counter(), 0
+        manuali_ora = [m for m in manuali if m.orario == ora_s]
+        occupati = {v for m in manuali_ora for v in m.volontari}
+        luoghi_occupati = {m.luogo for m in manuali_ora}
+        v_liberi = [v for v in volontari if v not in occupati]
+        l_liberi = [l for l in luoghi if l not in luoghi_occupati]
+
+        for _ in range(min(len(cani_restanti), len(l_liberi))):
+            if not v_liberi:
+                if traccia is not None:
+                    traccia.append({"evento": "volontari esauriti", "orario": ora_s,
+                                    "dettaglio": f"{len(l_liberi)} luoghi ancora liberi"})
+                break
+            for idx, cane in enumerate(cani_restanti):
+                conflitto = turno_in_conflitto(cane, l_liberi[0], chain(programma, manuali_ora), ora_s, contesto)
+                if conflitto is not None:
+                    if traccia is not None:
+                        traccia.append({"evento": "luogo rifiutato", "orario": ora_s, "cane": cane,
+                                        "luogo": l_liberi[0],
+                                        "dettaglio": f"reattività: {conflitto.cane} in {conflitto.luogo} (adiacente)"})
+                    continue
+                campo_scelto = l_liberi.pop(0)
+                cani_restanti.pop(idx)
+
+                # Trova volontario compatibile con controllo colori
+                candidati = [] if traccia is not None else None
+                volontario_scelto, colore_vol, compatibile, msg = trova_volontario_compatibile(
+                    cane, v_liberi, contesto, punteggi=candidati
+                )
+
+                if volontario_scelto:
+                    v_liberi.remove(volontario_scelto)
+
+                    # Traccia abbinamenti non compatibili
+                    if not compatibile:
+                        non_compatibili.append({
+                            'orario': ora_s,
+                            'cane': cane,
+                            'colore_cane': contesto["colori_cani"].get(cane, COLORE_CANE_SCONOSCIUTO),
+                            'volontario': volontario_scelto,
+                            'colore_volontario': colore_vol,
+                            'messaggio': msg
+                        })
+
+                    programma.append(Turno(ora_s, cane, (volontario_scelto,), campo_scelto, "Auto"))
+                    if traccia is not None:
+                        assegnati += 1
+                        traccia.append({"evento": "assegnazione", "orario": ora_s, "cane": cane,
+                                        "luogo": campo_scelto, "volontario": volontario_scelto,
+                                        "dettaglio": f"{msg} — {len(candidati)} candidati",
+                                        "candidati": candidati})
+                break
+            else:
+                # Nessun cane rimasto può usare il primo luogo libero
+                if traccia is not None:
+                    traccia.append({"evento": "luogo senza cane", "orario": ora_s, "luogo": l_liberi[0],
+                                    "dettaglio": "tutti i cani rimasti rifiutati per reattività"})
+        if traccia is not None:
+            traccia.append({"evento": "fascia", "orario": ora_s,
+                            "dettaglio": f"{assegnati} cani assegnati, {len(v_liberi)} volontari e "
+                                         f"{len(l_liberi)} luoghi liberi, {len(cani_restanti)} cani in attesa",
+                            "ms": (perf_counter() - inizio_fascia) * 1000})
+        curr_t += timedelta(minutes=45)
+
+    if traccia is not None:
+        for cane in cani_restanti:
+            traccia.append({"evento": "escluso", "cane": cane, "dettaglio": "nessun posto prima dei pasti"})
+
+    programma = sorted(chain(programma, manuali), key=chiave_turno)
+
+    # Pasti finali
+    inserisci_turno(programma, turno_collettivo(pasti_dt.strftime('%H:%M'), "Box", "Pasti"))
+
+    return programma, non_compatibili
+
+
+# --- SIMULAZIONE ASSENZE ---
+
+def _rimuovi_assenti(manuali, assenti):
+    """Toglie i volontari assenti dai turni manuali; i turni rimasti senza volontari vengono scartati."""
+    risultato = []
+    for m in manuali:
+        presenti = tuple(v for v in m.volontari if v not in assenti)
+        if len(presenti) == len(m.volontari):
+            risultato.append(m)
+        elif presenti:
+            risultato.append(replace(m, volontari=presenti))
+    return risultato
+
+
+def _simula_blocco(parametri):
+    """Esegue un blocco di iterazioni della simulazione (eseguito in un processo separato)."""
+    cani, volontari, luoghi, start_dt, end_dt, manuali, contesto, prob_assenza, iterazioni, seed = parametri
+    rng = random.Random(seed)
+    esiti = []
+    for _ in range(iterazioni):
+        assenti = frozenset(v for v in volontari if rng.random() < prob_assenza)
+        presenti = [v for v in volontari if v not in assenti]
+        programma, non_compatibili = genera_programma(
+            cani, presenti, luoghi, start_dt, end_dt, _rimuovi_assenti(manuali, assenti), contesto
+        )
+        cani_portati = sum(1 for t in programma if not t.collettivo)
+        incompatibili = sum(1 for t in programma if turno_compatibile(t, contesto) is False)
+        esiti.append((tuple(assenti), cani_portati, incompatibili))
+    return esiti
+
+
+def contesto_processi():
+    """
+    Contesto multiprocessing per i pool di processi: mai `fork`, che nel server
+    Streamlit duplicherebbe anche i suoi thread (scrittore del database compreso)
+    e può bloccarsi. `forkserver` dove disponibile, altrimenti `spawn`.
+    """
+    metodi = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in metodi else "spawn")
+
+
+def _percentile(valori_ordinati, p):
+    """Percentile (nearest-rank) di una lista già ordinata."""
+    if not valori_ordinati:
+        return 0
+    indice = max(0, min(len(valori_ordinati) - 1, round(p / 100 * len(valori_ordinati)) - 1))
+    return valori_ordinati[indice]
+
+
+def simula_assenze(cani, volontari, luoghi, start_dt, end_dt, manuali, contesto,
+                   prob_assenza=0.2, iterazioni=1000, seed=None, processi=None):
+    """
+    Simulazione Monte Carlo della robustezza del programma alle assenze dei volontari.
+
+    Per ogni iterazione ogni volontario è assente con probabilità `prob_assenza`;
+    il programma viene rigenerato con i presenti. Le iterazioni sono divise in
+    blocchi eseguiti in parallelo da un pool di processi.
+
+    Returns:
+        dict: distribuzioni di cani portati e abbinamenti incompatibili,
+        percentili e criticità dei singoli volontari.
+    """
+    processi = processi or os.cpu_count() or 1
+    seed = random.randrange(2**32) if seed is None else seed
+
+    # Più blocchi che processi per bilanciare il carico
+    n_blocchi = max(1, min(iterazioni, processi * 4))
+    dimensioni = [iterazioni // n_blocchi + (1 if i < iterazioni % n_blocchi else 0) for i in range(n_blocchi)]
+    blocchi = [
+        (cani, volontari, luoghi, start_dt, end_dt, manuali, contesto, prob_assenza, n, seed + i)
+        for i, n in enumerate(dimensioni) if n
+    ]
+
+    if processi > 1 and len(blocchi) > 1:
+        with ProcessPoolExecutor(max_workers=processi, mp_context=contesto_processi()) as pool:
+            risultati = list(pool.map(_simula_blocco, blocchi))
+    else:
+        risultati = [_simula_blocco(b) for b in blocchi]
+
+    esiti = [e for blocco in risultati for e in blocco]
+    cani_portati = [e[1] for e in esiti]
+    incompatibili = [e[2] for e in esiti]
+    ordinati = sorted(cani_portati)
+
+    # Criticità: quanti cani in meno vengono portati quando il volontario manca
+    somma_assente = Counter()
+    conta_assente = Counter()
+    somma_incomp_assente = Counter()
+    for assenti, portati, incomp in esiti:
+        for v in assenti:
+            somma_assente[v] += portati
+            conta_assente[v] += 1
+            somma_incomp_assente[v] += incomp
+
+    totale_portati = sum(cani_portati)
+    totale_incomp = sum(incompatibili)
+    criticita = []
+    for v in volontari:
+        n_assente = conta_assente[v]
+        n_presente = len(esiti) - n_assente
+        if not n_assente or not n_presente:
+            continue
+        media_assente = somma_assente[v] / n_assente
+        media_presente = (totale_portati - somma_assente[v]) / n_presente
+        incomp_assente = somma_incomp_assente[v] / n_assente
+        incomp_presente = (totale_incomp - somma_incomp_assente[v]) / n_presente
+        criticita.append({
+            'volontario': v,
+            'assenze_simulate': n_assente,
+            'cani_persi': round(media_presente - media_assente, 2),
+            'incompatibili_in_piu': round(incomp_assente - incomp_presente, 2),
+        })
+    criticita.sort(key=lambda c: (-c['cani_persi'], -c['incompatibili_in_piu']))
+
+    return {
+        'iterazioni': len(esiti),
+        'cani_totali': len(cani),
+        'cani_portati': cani_portati,
+        'incompatibili': incompatibili,
+        'media_cani': totale_portati / len(esiti) if esiti else 0,
+        'p10_cani': _percentile(ordinati, 10),
+        'p50_cani': _percentile(ordinati, 50),
+        'min_cani': ordinati[0] if ordinati else 0,
+        'media_incompatibili': totale_incomp / len(esiti) if esiti else 0,
+        'criticita': criticita,
+    }
@@ -0,0 +1,367 @@
+"""
+Prova di carico: quanti coordinatori contemporanei regge una singola istanza.
+
+Avvia N sessioni simultanee dell'app con `AppTest` nello stesso processo (come
+fa il server Streamlit, un thread per sessione) e fa eseguire a ciascuna un
+copione realistico: selezione di cani, volontari e luoghi, generazione
+automatica, aggiunta di un turno manuale, salvataggio nello storico ed
+esportazione Excel. Le sessioni lavorano su:
+- un server HTTP locale che imita l'endpoint CSV di Google Sheets
+  (variabile CANILE_URL_FOGLI);
+- un `canile.db` sintetico in una cartella temporanea (variabile CANILE_DB),
+  con anagrafica e storico di dimensioni configurabili.
+
+Al termine riporta i percentili della latenza dei rerun per passo del copione,
+gli errori di lock del database, i conflitti di versione sulle bozze e le
+altre eccezioni. Le eccezioni sollevate da `AppTest` stesso (non dall'app:
+AppTest non è pensato per più thread e ogni tanto fallisce nel ricostruire
+l'albero degli elementi) sono contate a parte come "driver": la sessione
+colpita si ferma e il codice di uscita non ne tiene conto.
+
+Uso:
+    python prova_carico.py --sessioni 8 --cicli 3
+    python prova_carico.py --sessioni 20 --stesso-giorno --csv prova_carico.csv
+"""
+import argparse
+import csv
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+COLORI = ["verde", "arancione", "rosso", "nero"]
+PERCENTILI = [50, 90, 95, 99]
+
+
+# --- DATI SINTETICI ---
+
+def fogli_sintetici(n_cani, n_volontari, n_luoghi, seed):
+    """Contenuto CSV dei fogli Cani, Volontari e Luoghi."""
+    rnd = random.Random(seed)
+    cani = ["nome,colore,reattività"] + [
+        f"Cane{i:03d},{rnd.choice(COLORI[:3])},{rnd.choice([0, 0, 0, 2, 5, 8])}" for i in range(n_cani)
+    ]
+    # Metà dei volontari esperti, così i programmi generati si possono salvare
+    volontari = ["nome,colore"] + [
+        f"Volontario{i:03d},{'nero' if i % 2 else rnd.choice(COLORI)}" for i in range(n_volontari)
+    ]
+    luoghi = ["nome,automatico,adiacente"] + [
+        f'Campo{i:02d},sì,"Campo{i - 1:02d},Campo{i + 1:02d}"' for i in range(n_luoghi)
+    ]
+    return {
+        "Cani": "\n".join(cani) + "\n",
+        "Volontari": "\n".join(volontari) + "\n",
+        "Luoghi": "\n".join(luoghi) + "\n",
+    }
+
+
+def crea_db_sintetico(percorso, n_cani, n_volontari, n_luoghi, giorni_storico, seed):
+    """Crea un canile.db con anagrafica completa e `giorni_storico` giorni di storico."""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(percorso)
+    conn.execute("CREATE TABLE storico (data TEXT, inizio TEXT, cane TEXT, volontario TEXT, luogo TEXT)")
+    conn.execute('''CREATE TABLE anagrafica_cani
+                    (nome TEXT PRIMARY KEY, cibo TEXT, guinzaglieria TEXT, strumenti TEXT,
+                     attivita TEXT, note TEXT, tempo TEXT)''')
+    conn.executemany(
+        "INSERT INTO anagrafica_cani VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(f"Cane{i:03d}", "Crocchette 200g mattina e sera", "Pettorina e guinzaglio lungo",
+          "Bocconcini", "Passeggiata e gioco con la palla", "Tira al guinzaglio vicino ad altri cani",
+          "45 minuti") for i in range(n_cani)]
+    )
+    oggi = date.today()
+    righe = []
+    for g in range(1, giorni_storico + 1):
+        giorno = (oggi - timedelta(days=g)).strftime("%Y-%m-%d")
+        for k in range(min(30, n_cani)):
+            righe.append((giorno, f"{14 + k // 10}:{(k % 10) * 5:02d}", f"Cane{rnd.randrange(n_cani):03d}",
+                          f"Volontario{rnd.randrange(n_volontari):03d}", f"Campo{rnd.randrange(n_luoghi):02d}"))
+    conn.executemany("INSERT INTO storico VALUES (?, ?, ?, ?, ?)", righe)
+    conn.commit()
+    conn.close()
+
+
+def avvia_server_fogli(fogli, ritardo):
+    """Server HTTP locale che risponde come l'esportazione CSV di Google Sheets."""
+
+    class Gestore(BaseHTTPRequestHandler):
+        def do_GET(self):
+            foglio = parse_qs(urlparse(self.path).query).get("sheet", [""])[0]
+            if foglio not in fogli:
+                self.send_error(404)
+                return
+            if ritardo:
+                time.sleep(ritardo)
+            corpo = fogli[foglio].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv; charset=utf-8")
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Gestore)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- SESSIONI ---
+
+class Registro:
+    """Raccoglie latenze ed errori da tutte le sessioni (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latenze = defaultdict(list)
+        self.errori = defaultdict(int)
+        self.esempi = {}
+
+    def latenza(self, passo, secondi):
+        with self._lock:
+            self.latenze[passo].append(secondi)
+
+    def errore(self, tipo, messaggio):
+        with self._lock:
+            self.errori[tipo] += 1
+            self.esempi.setdefault(tipo, messaggio)
+
+
+def classifica_errore(messaggio, predefinito="eccezione"):
+    testo = messaggio.lower()
+    if "database is locked" in testo or "database is busy" in testo or "database table is locked" in testo:
+        return "lock_db"
+    if "timeout" in testo or "timed out" in testo:
+        return "timeout"
+    return predefinito
+
+
+def _per_etichetta(elementi, testo):
+    for e in elementi:
+        if testo in e.label:
+            return e
+    raise LookupError(f"Elemento '{testo}' non trovato")
+
+
+class Sessione:
+    """Un coordinatore che esegue il copione sull'app."""
+
+    def __init__(self, numero, registro, args):
+        from streamlit.testing.v1 import AppTest
+
+        self.numero = numero
+        self.registro = registro
+        self.args = args
+        self.rnd = random.Random(args.seed * 1000 + numero)
+        self.at = AppTest.from_file(APP, default_timeout=args.timeout)
+        # Dopo un errore del driver lo stato di AppTest non è più affidabile
+        self.interrotta = False
+        if args.stesso_giorno:
+            self.giorno = date.today()
+        else:
+            self.giorno = date.today() + timedelta(days=1 + numero)
+
+    def passo(self, nome, azione=None):
+        """
+        Esegue un'interazione e il rerun che ne segue, misurandone la durata.
+        Le eccezioni dell'app arrivano in `at.exception`; quelle sollevate qui
+        vengono da AppTest (o sono timeout) e interrompono la sessione.
+        """
+        if self.interrotta:
+            return False
+        t0 = time.perf_counter()
+        try:
+            (azione or (lambda: None))()
+            self.at.run()
+        except Exception as e:
+            self.registro.errore(classifica_errore(repr(e), "driver"), f"{nome}: {e!r}")
+            self.interrotta = True
+            return False
+        self.registro.latenza(nome, time.perf_counter() - t0)
+        for ecc in self.at.exception:
+            self.registro.errore(classifica_errore(ecc.message), f"{nome}: {ecc.message}")
+        for avviso in self.at.warning:
+            if "altro coordinatore" in str(avviso.value):
+                self.registro.errore("conflitto_bozza", f"{nome}: {avviso.value}")
+        return not self.at.exception
+
+    def esegui(self):
+        at = self.at
+        if not self.passo("primo_caricamento"):
+            return
+        self.passo("data", lambda: at.date_input[0].set_value(self.giorno))
+        for _ in range(self.args.cicli):
+            if self.interrotta:
+                return
+            self.ciclo()
+
+    def ciclo(self):
+        at, rnd = self.at, self.rnd
+        cani = at.multiselect(key="cani_turno").options
+        volontari = at.multiselect(key="volontari_turno").options
+        luoghi = at.multiselect(key="luoghi_turno").options
+        scelta_cani = rnd.sample(cani, min(len(cani), rnd.randint(15, 35)))
+        scelta_vol = rnd.sample(volontari, min(len(volontari), rnd.randint(6, 14)))
+        scelta_luoghi = rnd.sample(luoghi, min(len(luoghi), rnd.randint(4, 8)))
+
+        self.passo("seleziona_cani", lambda: at.multiselect(key="cani_turno").set_value(scelta_cani))
+        self.passo("seleziona_volontari", lambda: at.multiselect(key="volontari_turno").set_value(scelta_vol))
+        self.passo("seleziona_luoghi", lambda: at.multiselect(key="luoghi_turno").set_value(scelta_luoghi))
+        self.passo("genera", lambda: _per_etichetta(at.button, "Genera").click())
+
+        def turno_manuale():
+            _per_etichetta(at.selectbox, "Seleziona Cane").set_value(rnd.choice(scelta_cani))
+            _per_etichetta(at.selectbox, "Seleziona Luogo").set_value(rnd.choice(scelta_luoghi))
+            _per_etichetta(at.multiselect, "Seleziona Volontari").set_value([rnd.choice(scelta_vol)])
+            _per_etichetta(at.button, "Aggiungi Turno Manuale").click()
+        self.passo("turno_manuale", turno_manuale)
+
+        self.passo("salva", lambda: _per_etichetta(at.button, "Salva Storico").click())
+        if any("incompatibili" in str(e.value) for e in at.error):
+            self.registro.errore("salvataggio_bloccato", "programma con abbinamenti incompatibili")
+        self.passo("esporta_excel", lambda: _per_etichetta(at.button, "Esporta Programma in Excel").click())
+        time.sleep(self.rnd.uniform(0, self.args.pausa))
+
+
+def prepara_driver_concorrente():
+    """
+    Adatta AppTest all'uso da più thread, come nel server Streamlit dove tutte le
+    sessioni condividono un solo Runtime e una sola ScriptCache:
+    - lo script viene compilato una volta sola (AppTest crea una ScriptCache
+      nuova a ogni rerun e più `ast.parse` concorrenti possono fallire);
+    - il Runtime resta disponibile anche quando un'altra sessione termina il
+      suo rerun (AppTest lo azzera alla fine di ogni esecuzione).
+    """
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    condivisa = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: condivisa
+
+    ultimo = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            ultimo["runtime"] = cls._instance
+            return cls._instance
+        if "runtime" in ultimo:
+            return ultimo["runtime"]
+        raise RuntimeError("Runtime hasn't been created!")
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or "runtime" in ultimo)
+
+
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    k = (len(ordinati) - 1) * p / 100
+    i = int(k)
+    j = min(i + 1, len(ordinati) - 1)
+    return ordinati[i] + (ordinati[j] - ordinati[i]) * (k - i)
+
+
+# --- MAIN ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Prova di carico con più coordinatori contemporanei")
+    parser.add_argument("--sessioni", type=int, default=5, help="Sessioni contemporanee")
+    parser.add_argument("--cicli", type=int, default=2, help="Ripetizioni del copione per sessione")
+    parser.add_argument("--cani", type=int, default=60)
+    parser.add_argument("--volontari", type=int, default=25)
+    parser.add_argument("--luoghi", type=int, default=12)
+    parser.add_argument("--giorni-storico", type=int, default=365, help="Giorni di storico nel DB sintetico")
+    parser.add_argument("--stesso-giorno", action="store_true",
+                        help="Tutte le sessioni lavorano sulla stessa data (bozza condivisa)")
+    parser.add_argument("--ritardo-fogli", type=float, default=0.2,
+                        help="Latenza simulata dell'endpoint dei fogli in secondi")
+    parser.add_argument("--pausa", type=float, default=0.5, help="Pausa massima tra un ciclo e l'altro (s)")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout di un singolo rerun (s)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cartella", help="Cartella di lavoro (default: temporanea)")
+    parser.add_argument("--csv", help="File CSV a cui accodare il riepilogo")
+    args = parser.parse_args()
+    if args.csv:
+        args.csv = os.path.abspath(args.csv)
+
+    cartella = args.cartella or tempfile.mkdtemp(prefix="prova_carico_")
+    os.makedirs(cartella, exist_ok=True)
+    percorso_db = os.path.join(cartella, "canile.db")
+    if os.path.exists(percorso_db):
+        sys.exit(f"{percorso_db} esiste già: usa una cartella vuota")
+    crea_db_sintetico(percorso_db, args.cani, args.volontari, args.luoghi, args.giorni_storico, args.seed)
+    server = avvia_server_fogli(
+        fogli_sintetici(args.cani, args.volontari, args.luoghi, args.seed), args.ritardo_fogli
+    )
+    os.environ["CANILE_DB"] = percorso_db
+    os.environ["CANILE_URL_FOGLI"] = (
+        f"http://127.0.0.1:{server.server_address[1]}/gviz/tq?tqx=out:csv&sheet={{foglio}}"
+    )
+    # I file esportati dall'app finiscono nella cartella di lavoro
+    os.chdir(cartella)
+
+    print(f"Cartella di lavoro: {cartella}")
+    print(f"{args.sessioni} sessioni x {args.cicli} cicli"
+          f"{' sulla stessa data' if args.stesso_giorno else ''}...")
+    prepara_driver_concorrente()
+    registro = Registro()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessioni) as pool:
+        futuri = [pool.submit(lambda n: Sessione(n, registro, args).esegui(), n) for n in range(args.sessioni)]
+        for futuro in futuri:
+            try:
+                futuro.result()
+            except Exception as e:
+                # Fuori da `passo`: elementi non trovati o stato di AppTest incoerente
+                registro.errore(classifica_errore(repr(e), "driver"), repr(e))
+    durata = time.perf_counter() - t0
+    server.shutdown()
+
+    tutte = [v for valori in registro.latenze.values() for v in valori]
+    print(f"\nDurata totale: {durata:.1f} s, rerun: {len(tutte)} ({len(tutte) / durata:.1f}/s)\n")
+    intestazione = f"{'passo':<22}{'n':>5}" + "".join(f"{'p' + str(p):>9}" for p in PERCENTILI) + f"{'max':>9}"
+    print(intestazione + "   (secondi)")
+    righe = sorted(registro.latenze.items()) + ([("TUTTI", tutte)] if tutte else [])
+    for passo, valori in righe:
+        print(f"{passo:<22}{len(valori):>5}"
+              + "".join(f"{percentile(valori, p):>9.3f}" for p in PERCENTILI) + f"{max(valori):>9.3f}")
+
+    print("\nErrori:")
+    for tipo in ("lock_db", "conflitto_bozza", "salvataggio_bloccato", "timeout", "eccezione", "driver"):
+        print(f"  {tipo:<22}{registro.errori.get(tipo, 0):>5}"
+              + (f"   es. {registro.esempi[tipo][:100]}" if tipo in registro.esempi else ""))
+    if registro.errori.get("driver"):
+        print("  (driver: errori di AppTest, non dell'app; le sessioni colpite sono state interrotte)")
+
+    if args.csv:
+        nuovo = not os.path.exists(args.csv)
+        with open(args.csv, "a", newline="") as f:
+            writer = csv.writer(f)
+            if nuovo:
+                writer.writerow(["timestamp", "host", "sessioni", "cicli", "stesso_giorno", "passo", "n"]
+                                + [f"p{p}" for p in PERCENTILI] + ["max", "lock_db", "conflitti"])
+            for passo, valori in righe:
+                writer.writerow(
+                    [datetime.now().isoformat(timespec="seconds"), platform.node(), args.sessioni, args.cicli,
+                     args.stesso_giorno, passo, len(valori)]
+                    + [round(percentile(valori, p), 4) for p in PERCENTILI]
+                    + [round(max(valori), 4), registro.errori.get("lock_db", 0),
+                       registro.errori.get("conflitto_bozza", 0)]
+                )
+
+    sys.exit(1 if registro.errori.get("lock_db") or registro.errori.get("eccezione") else 0)
+
+
+if __name__ == "__main__":
+    main()
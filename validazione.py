@@ -0,0 +1,162 @@
+"""
+Validazione e normalizzazione dei fogli Cani, Volontari e Luoghi.
+
+Viene eseguita una volta per caricamento, subito dopo il download: il resto
+dell'app lavora su tabelle già pulite (nomi senza spazi, colori validi in
+minuscolo, reattività numerica, adiacenze che puntano a luoghi esistenti) e
+non deve più normalizzare i valori a ogni confronto.
+
+Ogni anomalia diventa un `Problema` da mostrare nell'interfaccia. Le scelte
+sono prudenti: un cane con colore mancante o non riconosciuto è trattato come
+NERO e un volontario come VERDE, così un errore di battitura non affida mai
+un cane difficile a un principiante.
+"""
+from dataclasses import dataclass
+
+import pandas as pd
+
+from pianificatore import LIVELLI, LIVELLO_CANE_SCONOSCIUTO, Livello
+
+REATTIVITA_SCONOSCIUTA = 10
+VALORI_SI = {"sì", "si", "s", "yes", "y", "true", "1", "x"}
+VALORI_NO = {"no", "n", "false", "0", ""}
+
+
+@dataclass(frozen=True)
+class Problema:
+    """Un'anomalia trovata in un foglio; `riga` è il numero di riga nel foglio (None = tutto il foglio)."""
+    foglio: str
+    riga: int | None
+    nome: str
+    messaggio: str
+    grave: bool = True
+
+
+def _riga_foglio(indice):
+    # Riga 1 = intestazione
+    return int(indice) + 2
+
+
+def _testo(serie):
+    return serie.fillna("").astype(str).str.strip()
+
+
+def _nomi(df, foglio, problemi):
+    """Pulisce la colonna nome, scarta le righe senza nome e i duplicati (tiene la prima)."""
+    if "nome" not in df.columns:
+        raise ValueError(f"Il foglio {foglio} non ha la colonna 'nome'")
+    df["nome"] = _testo(df["nome"])
+    for indice in df.index[df["nome"] == ""]:
+        problemi.append(Problema(foglio, _riga_foglio(indice), "", "Riga senza nome: ignorata", grave=False))
+    df = df[df["nome"] != ""]
+    visti = {}
+    tenere = []
+    for indice, nome in df["nome"].items():
+        chiave = nome.casefold()
+        if chiave in visti:
+            problemi.append(Problema(foglio, _riga_foglio(indice), nome,
+                                     f"Nome duplicato (già alla riga {visti[chiave]}): riga ignorata"))
+            tenere.append(False)
+        else:
+            visti[chiave] = _riga_foglio(indice)
+            tenere.append(True)
+    return df[tenere].copy()
+
+
+def _colori(df, foglio, problemi, livello_prudente):
+    """Normalizza la colonna colore e aggiunge la colonna `livello`."""
+    prudente = livello_prudente.name.lower()
+    if "colore" not in df.columns:
+        problemi.append(Problema(foglio, None, "", f"Colonna 'colore' assente: tutti considerati {prudente}"))
+        df["colore"] = prudente
+        df["livello"] = int(livello_prudente)
+        return df
+    colori = _testo(df["colore"]).str.lower()
+    validi = colori.isin(LIVELLI.keys())
+    for indice, nome, valore in zip(df.index[~validi], df.loc[~validi, "nome"], df.loc[~validi, "colore"]):
+        descrizione = f"'{valore}' non riconosciuto" if str(valore).strip() and not pd.isna(valore) else "mancante"
+        problemi.append(Problema(foglio, _riga_foglio(indice), nome,
+                                 f"Colore {descrizione}: considerato {prudente}"))
+    df["colore"] = colori.where(validi, prudente)
+    df["livello"] = df["colore"].map(LIVELLI).astype(int)
+    return df
+
+
+def normalizza_cani(df):
+    """
+    Foglio Cani: nome, colore (+ livello) e reattività numerica.
+    Returns:
+        tuple: (DataFrame normalizzato, lista di Problema)
+    """
+    problemi = []
+    df = _nomi(df, "Cani", problemi)
+    df = _colori(df, "Cani", problemi, LIVELLO_CANE_SCONOSCIUTO)
+    if "reattività" not in df.columns:
+        df["reattività"] = 0
+    grezza = df["reattività"]
+    numerica = pd.to_numeric(grezza, errors="coerce")
+    vuota = grezza.isna() | (_testo(grezza) == "")
+    non_valida = (numerica.isna() & ~vuota) | (numerica < 0)
+    for indice, nome, valore in zip(df.index[non_valida], df.loc[non_valida, "nome"], grezza[non_valida]):
+        problemi.append(Problema("Cani", _riga_foglio(indice), nome,
+                                 f"Reattività '{valore}' non valida: considerata {REATTIVITA_SCONOSCIUTA}"))
+    df["reattività"] = numerica.where(~non_valida, REATTIVITA_SCONOSCIUTA).fillna(0).astype(float)
+    return df, problemi
+
+
+def normalizza_volontari(df):
+    """
+    Foglio Volontari: nome e colore (+ livello).
+    Returns:
+        tuple: (DataFrame normalizzato, lista di Problema)
+    """
+    problemi = []
+    df = _nomi(df, "Volontari", problemi)
+    df = _colori(df, "Volontari", problemi, Livello.VERDE)
+    return df, problemi
+
+
+def normalizza_luoghi(df):
+    """
+    Foglio Luoghi: `automatico` ridotto a 'sì'/'no' e `adiacente` ridotto ai soli
+    luoghi esistenti, separati da virgola.
+    Returns:
+        tuple: (DataFrame normalizzato, lista di Problema)
+    """
+    problemi = []
+    df = _nomi(df, "Luoghi", problemi)
+
+    if "automatico" not in df.columns:
+        df["automatico"] = "sì"
+    automatico = _testo(df["automatico"]).str.lower()
+    sconosciuto = ~automatico.isin(VALORI_SI | VALORI_NO)
+    for indice, nome, valore in zip(df.index[sconosciuto], df.loc[sconosciuto, "nome"], df.loc[sconosciuto, "automatico"]):
+        problemi.append(Problema("Luoghi", _riga_foglio(indice), nome,
+                                 f"Automatico '{valore}' non riconosciuto: considerato 'no'", grave=False))
+    df["automatico"] = automatico.isin(VALORI_SI).map({True: "sì", False: "no"})
+
+    if "adiacente" not in df.columns:
+        df["adiacente"] = ""
+    per_chiave = {nome.casefold(): nome for nome in df["nome"]}
+    adiacenti = []
+    for indice, nome, testo in zip(df.index, df["nome"], _testo(df["adiacente"])):
+        risolti = []
+        for rif in (r.strip() for r in testo.split(",")):
+            if not rif:
+                continue
+            luogo = per_chiave.get(rif.casefold())
+            if luogo is None:
+                problemi.append(Problema("Luoghi", _riga_foglio(indice), nome,
+                                         f"Luogo adiacente '{rif}' inesistente: ignorato"))
+            elif luogo != nome and luogo not in risolti:
+                risolti.append(luogo)
+        adiacenti.append(",".join(risolti))
+    df["adiacente"] = adiacenti
+    return df, problemi
+
+
+NORMALIZZATORI = {
+    "Cani": normalizza_cani,
+    "Volontari": normalizza_volontari,
+    "Luoghi": normalizza_luoghi,
+}